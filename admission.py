@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import os
+import threading
+import time
+
+from flask import g, jsonify, request
+
+import subscription_manager
+
+logger = logging.getLogger(__name__)
+
+# 准入控制：每个gunicorn worker进程独立计数（gthread模式下一个进程有WORKER_THREADS个处理线程）
+# 昂贵请求（转换、需要下载上游的合并）运行+排队占用的线程数不超过 WORKER_THREADS - RESERVED_THREADS，
+# 剩下的线程保留给 /health、key://缓存直出等廉价请求
+WORKER_THREADS = int(os.environ.get('ADMISSION_WORKER_THREADS', '8'))
+RESERVED_THREADS = int(os.environ.get('ADMISSION_RESERVED_THREADS', '2'))
+EXPENSIVE_BUDGET = max(1, WORKER_THREADS - RESERVED_THREADS)
+
+# 各路由同时运行的昂贵请求上限
+ROUTE_LIMITS = {
+    'clash_convert': int(os.environ.get('ADMISSION_LIMIT_CLASH_CONVERT', '2')),
+    'clash_proxy': int(os.environ.get('ADMISSION_LIMIT_CLASH', '3')),
+    'input_page': int(os.environ.get('ADMISSION_LIMIT_INPUT', '2')),
+}
+
+# 等待队列长度上限和最长等待时间（秒），超出直接返回503
+MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', '4'))
+QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '30'))
+# 503/429响应里的Retry-After（秒）
+RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', '30'))
+
+# 每个客户端的令牌桶限流：每分钟补充RATE_LIMIT_PER_MINUTE个，最多积累RATE_LIMIT_BURST个
+RATE_LIMIT_PER_MINUTE = float(os.environ.get('ADMISSION_RATE_LIMIT_PER_MINUTE', '60'))
+RATE_LIMIT_BURST = float(os.environ.get('ADMISSION_RATE_LIMIT_BURST', '30'))
+# 部署在反向代理后面时，用X-Forwarded-For的第一个地址识别客户端
+TRUST_FORWARDED_FOR = os.environ.get('ADMISSION_TRUST_FORWARDED_FOR', '').lower() == 'true'
+
+# 不做任何准入控制的路由
+EXEMPT_ENDPOINTS = {'health_check', 'index', 'admission_stats', 'static'}
+
+_lock = threading.Lock()
+_slot_available = threading.Condition(_lock)
+_running = {route: 0 for route in ROUTE_LIMITS}
+_waiting = {route: 0 for route in ROUTE_LIMITS}
+_buckets = {}
+_stats = {
+    'admitted': 0,
+    'admitted_cheap': 0,
+    'rejected_queue_full': 0,
+    'rejected_queue_timeout': 0,
+    'rejected_rate_limited': 0,
+    'max_queue_depth': 0,
+}
+
+
+def classify(endpoint):
+    """
+    判断请求的开销：exempt（不限制）、cheap（走保留线程）、expensive（受路由并发和队列限制）
+    """
+    if endpoint in EXEMPT_ENDPOINTS or endpoint is None:
+        return 'exempt'
+    if subscription_manager.is_prewarming():
+        # 预热调度器在本进程内重放的请求，并发已由调度器自己控制
+        return 'exempt'
+    if endpoint == 'clash_proxy':
+        sources = [request.args.get('url', '')] + request.args.getlist('apply_sub')
+        ua = request.args.get('ua') or 'clash-verge/v2.4.3'
+        # 所有来源都是key://缓存（没有开启try_update）或新鲜的预热结果时不需要访问上游
+        if subscription_manager.served_from_cache(sources, ua):
+            return 'cheap'
+        return 'expensive'
+    if endpoint == 'input_page' and request.method == 'GET':
+        return 'cheap'
+    if endpoint in ROUTE_LIMITS:
+        # /clash_convert即使有预热结果或输出缓存也按昂贵请求处理：判断命中需要先下载各个来源
+        return 'expensive'
+    return 'cheap'
+
+
+def _client_id():
+    if TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get('X-Forwarded-For', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote_addr or 'unknown'
+
+
+def _take_token(client):
+    """令牌桶限流，返回需要等待的秒数（0表示放行）"""
+    now = time.monotonic()
+    rate = RATE_LIMIT_PER_MINUTE / 60.0
+    with _lock:
+        tokens, updated = _buckets.get(client, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - updated) * rate)
+        if tokens < 1:
+            _buckets[client] = (tokens, now)
+            return math.ceil((1 - tokens) / rate) if rate > 0 else RETRY_AFTER
+        _buckets[client] = (tokens - 1, now)
+
+        # 定期清理已经回满的桶，避免客户端很多时无限增长
+        if len(_buckets) > 10000:
+            for key, (bucket_tokens, bucket_updated) in list(_buckets.items()):
+                if bucket_tokens + (now - bucket_updated) * rate >= RATE_LIMIT_BURST:
+                    del _buckets[key]
+    return 0
+
+
+def _reject(reason, status, retry_after):
+    """记录拒绝次数并生成带Retry-After的503/429响应（调用方需持有_lock）"""
+    _stats[f'rejected_{reason}'] += 1
+    logger.warning(f"准入拒绝({reason}): {request.path} 客户端: {_client_id()} 队列: {dict(_waiting)} 运行中: {dict(_running)}")
+    response = jsonify({'error': '服务繁忙，请稍后重试' if status == 503 else '请求过于频繁，请稍后重试'})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def before_request():
+    """准入检查：被拒绝时返回503/429响应，放行时返回None"""
+    kind = classify(request.endpoint)
+    if kind == 'exempt':
+        return None
+
+    wait = _take_token(_client_id())
+    if wait:
+        with _lock:
+            return _reject('rate_limited', 429, wait)
+
+    if kind == 'cheap':
+        with _lock:
+            _stats['admitted_cheap'] += 1
+        return None
+
+    route = request.endpoint
+    deadline = time.monotonic() + QUEUE_TIMEOUT
+    with _slot_available:
+        in_use = sum(_running.values()) + sum(_waiting.values())
+        queue_depth = sum(_waiting.values())
+        if in_use >= EXPENSIVE_BUDGET or (_running[route] >= ROUTE_LIMITS[route] and queue_depth >= MAX_QUEUE):
+            return _reject('queue_full', 503, RETRY_AFTER)
+
+        _waiting[route] += 1
+        _stats['max_queue_depth'] = max(_stats['max_queue_depth'], sum(_waiting.values()))
+        try:
+            while _running[route] >= ROUTE_LIMITS[route]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return _reject('queue_timeout', 503, RETRY_AFTER)
+                _slot_available.wait(remaining)
+        finally:
+            _waiting[route] -= 1
+
+        _running[route] += 1
+        _stats['admitted'] += 1
+    g.admission_route = route
+    return None
+
+
+def teardown_request(exc=None):
+    """释放请求占用的路由并发名额"""
+    route = g.pop('admission_route', None)
+    if route is None:
+        return
+    with _slot_available:
+        _running[route] -= 1
+        _slot_available.notify_all()
+
+
+def stats():
+    """当前进程的准入统计：队列深度、运行中请求数和拒绝次数"""
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'queue_depth': sum(_waiting.values()),
+            'waiting': dict(_waiting),
+            'running': dict(_running),
+            'limits': dict(ROUTE_LIMITS),
+            'expensive_budget': EXPENSIVE_BUDGET,
+            'max_queue': MAX_QUEUE,
+            **_stats,
+        }
+
+
+def init_app(app):
+    """注册准入控制钩子"""
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
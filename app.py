@@ -4,6 +4,7 @@
 import base64
 import requests
 from flask import Flask, request, jsonify, Response, render_template
+from werkzeug.http import http_date
 import logging
 from urllib.parse import quote, urlencode
 import os
@@ -12,8 +13,14 @@ import re
 import fix_shortid
 import yaml
 import json
+import copy
 from datetime import datetime
 import subscription_manager
+import merge_cache
+import local_converter
+import admission
+import fast_output
+import prewarm
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -32,6 +39,15 @@ if not os.path.exists(CACHE_DIR):
 
 app = Flask(__name__, template_folder=TEMPLATE_DIR)
 
+# 同一个请求里准入判断、下载订阅等多处读取存储，只解析一次存储文件（需在准入控制之前注册）
+app.before_request(subscription_manager.begin_request)
+app.teardown_request(subscription_manager.end_request)
+
+# 准入控制：路由并发限制、等待队列、客户端限流，并给廉价请求保留处理线程
+admission.init_app(app)
+# 预热调度：登记客户端轮询，在下次轮询前提前更新订阅、转换结果（多worker时只在一个进程运行）
+prewarm.init_app(app)
+
 def get_storage():
     """从JSON文件读取存储数据"""
     try:
@@ -56,23 +72,54 @@ def set_storage_item(key, value):
         logger.error(f"保存存储文件失败: {e}")
         raise
 
+def _is_not_modified(etag, last_modified=None):
+    """按If-None-Match / If-Modified-Since判断客户端缓存是否仍然有效（If-None-Match优先）"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag.strip('"'))
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+def _conditional_response(body, status, headers, etag=None, last_modified=None):
+    """
+    生成带ETag/Last-Modified的响应，客户端缓存有效时返回不带body的304
+    命中输出缓存时传入缓存里的etag，不需要再计算body哈希
+    """
+    if status != 200:
+        return Response(body, status=status, headers=headers)
+
+    headers = dict(headers)
+    headers['ETag'] = etag or merge_cache.make_etag(body)
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+
+    if _is_not_modified(headers['ETag'], last_modified):
+        logger.info(f"客户端缓存有效，返回304: {headers['ETag']}")
+        not_modified_headers = {k: v for k, v in headers.items() if k not in ('Content-Type', 'Content-Disposition')}
+        return Response(status=304, headers=not_modified_headers)
+
+    return Response(body, status=status, headers=headers)
+
 @app.route('/clash', methods=['GET'])
 def clash_proxy():
     """
     订阅代理接口
     支持: key://缓存key、http(s)://直接URL、base64编码的URL
     支持apply_sub参数，可以合并多个订阅的proxies
+    合并结果按各订阅内容哈希缓存，输入未变化时直接返回缓存
+    支持format参数：yaml（默认）、json、json-lines
     """
-    temp_files = []  # 用于跟踪需要清理的临时文件
-    
     try:
         # 获取url参数（支持key://、http(s)://或base64）
         url_param = request.args.get('url')
         ua = request.args.get('ua')
         apply_sub_list = request.args.getlist('apply_sub')  # 获取额外订阅列表
+        output_format = request.args.get('format', 'yaml')
         
         if not url_param:
             return jsonify({'error': '缺少url参数'}), 400
+        if output_format not in fast_output.OUTPUT_FORMATS:
+            return jsonify({'error': f'不支持的format: {output_format}'}), 400
         if not ua:
             ua='clash-verge/v2.4.3'
 
@@ -90,29 +137,62 @@ def clash_proxy():
         if subscription_userinfo:
             response_headers['Subscription-Userinfo'] = subscription_userinfo
         response_headers['Content-Type'] = 'text/yaml; charset=utf-8'
-        
-        # 如果没有额外订阅，直接返回内容
-        if not apply_sub_list:
-            return Response(
+
+        # 如果没有额外订阅且输出YAML，直接返回内容
+        if not apply_sub_list and output_format == 'yaml':
+            # 所有来源都是key://缓存时，用cached_time作为Last-Modified
+            last_modified = subscription_manager.get_last_modified([url_param])
+            return _conditional_response(
                 yaml_content.encode('utf-8'),
-                status=status_code,
-                headers=response_headers
+                status_code,
+                response_headers,
+                last_modified=last_modified
             )
         
-        # 有额外订阅，需要合并
-        logger.info(f"检测到 {len(apply_sub_list)} 个额外订阅")
+        # 有额外订阅需要合并，或者需要转换输出格式
+        logger.info(f"检测到 {len(apply_sub_list)} 个额外订阅，输出格式: {output_format}")
+
+        # 先下载所有额外订阅，用内容哈希判断合并结果是否可以复用
+        sub_contents = []
+        for idx, sub_b64 in enumerate(apply_sub_list):
+            try:
+                # 使用subscription_manager下载额外订阅
+                sub_yaml_content, _, sub_status = subscription_manager.download_subscription(sub_b64, ua)
+                
+                if sub_yaml_content is None:
+                    logger.warning(f"额外订阅 {idx+1} 下载失败，状态码: {sub_status}")
+                    continue
+                
+                sub_contents.append((idx, sub_yaml_content, merge_cache.content_hash(sub_yaml_content)))
+            except Exception as e:
+                logger.error(f"下载额外订阅 {idx+1} 时出错: {e}")
+                continue
+
+        last_modified = subscription_manager.get_last_modified([url_param] + apply_sub_list)
+        main_hash = merge_cache.content_hash(yaml_content)
+        cache_key = merge_cache.build_key(
+            'clash', main_hash, *[sub_hash for _, _, sub_hash in sub_contents], format=output_format
+        )
+        cached = merge_cache.get_output(cache_key)
+        if cached is not None:
+            logger.info(f"合并输入未变化，返回缓存结果: {cache_key[:12]}")
+            return _conditional_response(
+                cached['body'],
+                status_code,
+                response_headers,
+                etag=cached['etag'],
+                last_modified=last_modified
+            )
         
         try:
-            main_yaml = yaml.safe_load(yaml_content)
-            if not isinstance(main_yaml, dict):
+            # 解析结果是共享缓存，只做浅复制，不修改原有的proxies列表
+            main_parsed = merge_cache.load_subscription(yaml_content, main_hash)
+            if not isinstance(main_parsed, dict):
                 logger.error("主订阅内容不是有效的YAML字典")
                 return jsonify({'error': '主订阅内容格式错误'}), 500
             
-            # 确保主订阅有proxies字段
-            if 'proxies' not in main_yaml:
-                main_yaml['proxies'] = []
-            
-            main_proxies = main_yaml['proxies']
+            main_yaml = dict(main_parsed)
+            main_proxies = list(main_parsed.get('proxies') or [])
             logger.info(f"主订阅包含 {len(main_proxies)} 个代理")
             
         except Exception as e:
@@ -120,17 +200,10 @@ def clash_proxy():
             return jsonify({'error': f'主订阅YAML解析失败: {str(e)}'}), 500
         
         # 处理额外订阅合并
-        for idx, sub_b64 in enumerate(apply_sub_list):
+        for idx, sub_yaml_content, sub_hash in sub_contents:
             try:
-                # 使用subscription_manager下载额外订阅
-                sub_yaml_content, _, sub_status = subscription_manager.download_subscription(sub_b64, ua)
-                
-                if sub_yaml_content is None:
-                    logger.warning(f"额外订阅 {idx+1} 下载失败，状态码: {sub_status}")
-                    continue
-                
-                # 解析额外订阅YAML
-                sub_yaml = yaml.safe_load(sub_yaml_content)
+                # 解析额外订阅（YAML或分享链接，内容未变化时复用解析结果）
+                sub_yaml = merge_cache.load_subscription(sub_yaml_content, sub_hash)
                 
                 if not isinstance(sub_yaml, dict):
                     logger.warning(f"额外订阅 {idx+1} 不是有效的YAML字典")
@@ -152,57 +225,203 @@ def clash_proxy():
         main_yaml['proxies'] = main_proxies
         logger.info(f"合并完成，总共 {len(main_proxies)} 个代理")
         
-        # 生成临时文件
-        random_num = random.randint(100000, 999999)
-        temp_filename = f"temp_merged_{random_num}.yaml"
-        temp_files.append(temp_filename)
-        
-        # 写入临时文件
-        try:
-            with open(temp_filename, 'w', encoding='utf-8') as f:
-                yaml.dump(main_yaml, f, allow_unicode=True, sort_keys=False)
-            logger.info(f"合并内容已保存到临时文件: {temp_filename}")
-            
-            # 读取文件内容
-            with open(temp_filename, 'r', encoding='utf-8') as f:
-                merged_content = f.read()
-            
-        except Exception as e:
-            logger.error(f"临时文件操作失败: {e}")
-            return jsonify({'error': f'文件操作失败: {str(e)}'}), 500
-        
-        # 确保Content-Type正确设置
-        if 'Content-Type' not in response_headers:
-            response_headers['Content-Type'] = 'text/yaml; charset=utf-8'
+        if output_format == 'yaml':
+            merged_body = fast_output.dump_yaml(main_yaml).encode('utf-8')
+        else:
+            merged_body = fast_output.dump_json(main_yaml, one_item_per_line=output_format == 'json-lines').encode('utf-8')
+        merged_etag = merge_cache.make_etag(merged_body)
+        merge_cache.set_output(cache_key, merged_body, merged_etag)
         
         logger.info(f"返回headers: {response_headers}")
         
         # 返回合并后的内容
-        return Response(
-            merged_content.encode('utf-8'),
-            status=status_code,
-            headers=response_headers
+        return _conditional_response(
+            merged_body,
+            status_code,
+            response_headers,
+            etag=merged_etag,
+            last_modified=last_modified
         )
             
     except Exception as e:
         logger.error(f"处理请求时出错: {e}")
         return jsonify({'error': f'服务器内部错误: {str(e)}'}), 500
-    
-    finally:
-        # 清理临时文件
-        for temp_file in temp_files:
+
+def _apply_cover(main_yaml, cover_yaml):
+    """
+    用 cover_yaml 覆盖/新增 main_yaml 的 proxy-groups，并按 dialers 给 proxies 添加 dialer-proxy
+    会直接修改 main_yaml
+    """
+    main_groups = main_yaml.get('proxy-groups', [])
+    cover_groups = cover_yaml.get('proxy-groups', [])
+
+    if isinstance(main_groups, list) and isinstance(cover_groups, list):
+        # 创建映射以加快查找
+        main_group_map = {g.get('name'): i for i, g in enumerate(main_groups) if isinstance(g, dict) and 'name' in g}
+
+        covered_count = 0
+        added_count = 0
+        for c_group in cover_groups:
+            if not isinstance(c_group, dict): continue
+
+            # 扩展 proxy-groups.use：按 main_yaml 的 proxy-providers 做全匹配/正则匹配，然后改写 use 列表
+            # 规则：use 是 list；每个元素先尝试完全匹配 provider 名，不中则当正则去匹配多个 provider
+            # 顺序：按 use 原顺序处理；正则匹配结果按 main_yaml.proxy-providers 的 key 顺序输出；去重保序
             try:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-                    logger.info(f"临时文件已删除: {temp_file}")
+                if 'use' in c_group and isinstance(c_group.get('use'), list):
+                    providers = main_yaml.get('proxy-providers', {})
+                    if isinstance(providers, dict) and providers:
+                        provider_names = list(providers.keys())
+                        new_use = []
+                        seen = set()
+                        for use_item in c_group.get('use', []):
+                            if not isinstance(use_item, str) or not use_item:
+                                continue
+
+                            # 1) 完全匹配优先
+                            if use_item in providers:
+                                if use_item not in seen:
+                                    new_use.append(use_item)
+                                    seen.add(use_item)
+                                continue
+
+                            # 2) 正则匹配（合法正则才生效）
+                            try:
+                                reg = re.compile(use_item)
+                            except re.error:
+                                logger.warning(f"proxy-group use 项不是合法正则且无完全匹配: {use_item}")
+                                continue
+
+                            matched_any = False
+                            for pname in provider_names:
+                                try:
+                                    if reg.search(pname):
+                                        matched_any = True
+                                        if pname not in seen:
+                                            new_use.append(pname)
+                                            seen.add(pname)
+                                except Exception:
+                                    continue
+
+                            if not matched_any:
+                                logger.warning(f"proxy-group use 正则未匹配到任何 proxy-providers: {use_item}")
+
+                        if new_use:
+                            c_group['use'] = new_use
+                    else:
+                        logger.warning("main_yaml 没有有效的 proxy-providers，跳过 proxy-group use 改写")
             except Exception as e:
-                logger.error(f"删除临时文件失败 {temp_file}: {e}")
+                logger.error(f"处理 proxy-group use 改写时出错: {e}")
+
+            c_name = c_group.get('name')
+            if c_name:
+                if c_name in main_group_map:
+                    idx = main_group_map[c_name]
+                    main_groups[idx] = c_group
+                    covered_count += 1
+                else:
+                    main_groups.append(c_group)
+                    added_count += 1
+
+        if covered_count > 0 or added_count > 0:
+            main_yaml['proxy-groups'] = main_groups
+            logger.info(f"成功覆盖了 {covered_count} 个, 新增了 {added_count} 个 proxy-groups")
+        else:
+            logger.info("没有匹配的 proxy-groups 需要处理")
+    else:
+        logger.warning("main_yaml 或 cover_yaml 的 proxy-groups 不是列表")
+
+    # 处理 dialers 字段，给 proxies 添加 dialer-proxy
+    dialers = cover_yaml.get('dialers', [])
+    if isinstance(dialers, list) and len(dialers) > 0:
+        # name 支持：完全匹配 或 正则表达式匹配
+        exact_dialer_map = {}
+        regex_dialers = []
+        for d in dialers:
+            if not (isinstance(d, dict) and 'name' in d and 'dialer-proxy' in d):
+                continue
+            name_pat = d.get('name')
+            dialer_proxy = d.get('dialer-proxy')
+            if not isinstance(name_pat, str) or not name_pat:
+                continue
+            # exact 优先，regex 放列表按顺序匹配
+            exact_dialer_map[name_pat] = dialer_proxy
+            try:
+                regex_dialers.append((name_pat, re.compile(name_pat), dialer_proxy))
+            except re.error:
+                # 不是合法正则也没关系，照样保留 exact
+                pass
+
+        if exact_dialer_map or regex_dialers:
+            logger.info(f"发现 dialer 配置: exact={len(exact_dialer_map)}, regex={len(regex_dialers)}")
+
+            main_proxies = main_yaml.get('proxies', [])
+            if not isinstance(main_proxies, list):
+                main_proxies = []
+                main_yaml['proxies'] = main_proxies
+
+            dialer_count = 0
+            for proxy in main_proxies:
+                if not (isinstance(proxy, dict) and 'name' in proxy):
+                    continue
+                proxy_name = proxy.get('name')
+                if not isinstance(proxy_name, str):
+                    continue
+
+                # 1) 完全匹配优先
+                if proxy_name in exact_dialer_map:
+                    proxy['dialer-proxy'] = exact_dialer_map[proxy_name]
+                    dialer_count += 1
+                    continue
+
+                # 2) 正则匹配（按 cover_yaml 的 dialers 顺序）
+                for _, reg, dialer_proxy in regex_dialers:
+                    try:
+                        if reg.search(proxy_name):
+                            proxy['dialer-proxy'] = dialer_proxy
+                            dialer_count += 1
+                            break
+                    except Exception:
+                        continue
+
+            if dialer_count > 0:
+                main_yaml['proxies'] = main_proxies
+                logger.info(f"成功为 {dialer_count} 个代理添加了 dialer-proxy")
+
+def _fetch_remote_convert(convert_url):
+    """
+    请求远程转换服务，返回 (status_code, response_headers, content)
+    预热调度器刚请求过时直接使用预热结果；预热时把成功的结果写入预热缓存
+    """
+    prewarmed = subscription_manager.get_prewarmed('convert', convert_url)
+    if prewarmed is not None:
+        return 200, prewarmed['headers'], prewarmed['content']
+
+    # 发送GET请求到转换服务（流式读取、限制大小，按固定顺序解码）
+    status_code, upstream_headers, content = subscription_manager.fetch_text(convert_url, timeout=60)
+    logger.info(f"转换请求状态码: {status_code}")
+
+    # 提取特定的响应头
+    response_headers = {}
+    headers_to_copy = ['Strict-Transport-Security', 'Subscription-Userinfo', 'Vary', 'X-Cache']
+    for header_name in headers_to_copy:
+        if header_name in upstream_headers:
+            response_headers[header_name] = upstream_headers[header_name]
+
+    if status_code == 200:
+        subscription_manager.store_prewarmed('convert', convert_url, {
+            'content': content,
+            'headers': response_headers,
+        })
+    return status_code, response_headers, content
 
 @app.route('/clash_convert', methods=['GET'])
 def clash_convert():
     """
     Clash配置转换接口
     接收url、config、convert_url三个base64参数，向convert_url发送转换请求
+    engine=local时订阅如果已经是Clash YAML，在本地按config生成配置，失败时回退到远程转换
+    format=json/json-lines时用JSON输出（合法YAML），不需要short-id文本修复
     """
     try:
         # 获取base64参数
@@ -211,10 +430,16 @@ def clash_convert():
         convert_url_b64 = request.args.get('convert_url')
         cover_url_b64 = request.args.get('cover_url')
         mix_subs_list = request.args.getlist('mix_subs')  # 混合订阅列表（支持 key://、http(s)://、base64）
+        engine = request.args.get('engine', 'remote')  # 转换引擎：remote（远程subconverter）或 local（本地转换）
+        include = request.args.get('include', '')  # 节点名包含过滤（正则）
+        exclude = request.args.get('exclude', '')  # 节点名排除过滤（正则）
+        output_format = request.args.get('format', 'yaml')  # 输出格式：yaml、json、json-lines
         
         # 检查必需参数
         if not url_b64:
             return jsonify({'error': '缺少url参数'}), 400
+        if output_format not in fast_output.OUTPUT_FORMATS:
+            return jsonify({'error': f'不支持的format: {output_format}'}), 400
         if config_b64:
             config = base64.b64decode(config_b64).decode('utf-8')
         else:
@@ -244,8 +469,8 @@ def clash_convert():
             'new_name': 'true',
             'url': url,
             'config': config,
-            'include': '',
-            'exclude': '',
+            'include': include,
+            'exclude': exclude,
             'emoji': 'true',
             'list': 'false',
             'sort': 'false',
@@ -258,20 +483,25 @@ def clash_convert():
         }
         # 组装convert_url
         convert_url = convert_url + '?' + urlencode(params)
-        # 发送GET请求到转换服务
+
+        # 本地转换：下载并解析订阅和config，任何一步不满足条件都回退到远程转换
+        local_job = None
+        if engine == 'local':
+            try:
+                local_job = local_converter.prepare(url, config, include=include, exclude=exclude)
+                logger.info(f"使用本地转换: {len(local_job.sources)} 个订阅")
+            except local_converter.LocalConvertError as e:
+                logger.warning(f"本地转换不可用，回退到远程转换: {e}")
+
         try:
-            response = requests.get(convert_url, timeout=60)
-            logger.info(f"转换请求状态码: {response.status_code}")
-            
-            # 提取特定的响应头
-            response_headers = {}
-            headers_to_copy = ['Strict-Transport-Security', 'Subscription-Userinfo', 'Vary', 'X-Cache']
-            for header_name in headers_to_copy:
-                if header_name in response.headers:
-                    response_headers[header_name] = response.headers[header_name]
-            
-            # 获取响应内容
-            content = response.content
+            if local_job is not None:
+                status_code = 200
+                response_headers = {}
+                if local_job.subscription_userinfo:
+                    response_headers['Subscription-Userinfo'] = local_job.subscription_userinfo
+                content = None
+            else:
+                status_code, response_headers, content = _fetch_remote_convert(convert_url)
             
             # 生成随机数作为文件名
             random_num = random.randint(100000, 999999)
@@ -280,52 +510,124 @@ def clash_convert():
 
             # 确保内容以UTF-8编码保存到临时文件
             try:
-                # 如果content是bytes，尝试解码为字符串
-                if isinstance(content, bytes):
+                # 下载时已经解码为字符串（本地转换没有文本内容，后面直接生成字典）
+                content_str = content
+
+                # 先下载 mix_subs 和 cover_url，用各组件内容哈希判断输出是否可以复用
+                mix_contents = []
+                for idx, mix_url in enumerate(mix_subs_list):
                     try:
-                        content_str = content.decode('utf-8')
-                    except UnicodeDecodeError:
-                        # 如果不是UTF-8，尝试其他编码
-                        try:
-                            content_str = content.decode('gbk')
-                        except UnicodeDecodeError:
-                            # 如果都失败，使用错误替换模式
-                            content_str = content.decode('utf-8', errors='replace')
-                else:
-                    content_str = content
+                        mix_content, _, mix_status = subscription_manager.download_subscription(
+                            mix_url, 'clash-verge/v2.4.3'
+                        )
+                        if mix_content is None:
+                            logger.warning(f"mix_subs {idx+1} 下载失败，状态码: {mix_status}")
+                            continue
+                        mix_contents.append((idx, mix_content, merge_cache.content_hash(mix_content)))
+                    except Exception as e:
+                        logger.error(f"下载 mix_subs {idx+1} 时出错: {e}")
+                        continue
+
+                cover_content = None
+                if cover_url:
+                    try:
+                        # 使用 subscription_manager 下载
+                        cover_content, _, _ = subscription_manager.download_subscription(cover_url, 'clash-verge/v2.4.3')
+                        if not cover_content:
+                            logger.warning("cover_url 下载内容为空")
+                    except Exception as e:
+                        logger.error(f"下载 cover_url 时出错: {e}")
+                        cover_content = None
+
+                def source_last_modified():
+                    """所有来源都是key://缓存时才有Last-Modified"""
+                    source_urls = local_job.source_urls if local_job is not None else [url]
+                    result = subscription_manager.get_last_modified(
+                        source_urls + mix_subs_list + ([cover_url] if cover_url else [])
+                    )
+                    if result is not None and local_job is not None:
+                        # 本地转换的结果还取决于config，取两者中较新的时间
+                        result = max(result, local_job.config_changed_at)
+                    return result
+
+                def output_cache_key(main_hash):
+                    return merge_cache.build_key(
+                        'clash_convert',
+                        main_hash,
+                        *[mix_hash for _, _, mix_hash in mix_contents],
+                        cover=merge_cache.content_hash(cover_content) if cover_content else None,
+                        format=output_format
+                    )
+
+                def cached_response():
+                    """输入未变化时直接返回缓存的输出（不做任何YAML解析）"""
+                    cached = merge_cache.get_output(cache_key) if status_code == 200 else None
+                    if cached is None:
+                        return None
+                    logger.info(f"转换输入未变化，返回缓存结果: {cache_key[:12]}")
+                    response_headers['Content-Type'] = 'application/octet-stream; charset=utf-8'
+                    response_headers['Content-Disposition'] = 'attachment; filename="clash_sub.yaml"'
+                    return _conditional_response(
+                        cached['body'],
+                        status_code,
+                        response_headers,
+                        etag=cached['etag'],
+                        last_modified=last_modified
+                    )
+
+                last_modified = source_last_modified()
+                main_hash = local_job.key if local_job is not None else merge_cache.content_hash(content_str)
+                cache_key = output_cache_key(main_hash)
+                cached = cached_response()
+                if cached is not None:
+                    return cached
+
+                # 只解析一次主配置；解析结果是共享缓存，修改前先深复制
+                main_yaml = None
+                main_changed = False
+                if local_job is not None:
+                    try:
+                        # 本地转换到这里才解析订阅，来源不是Clash YAML/分享链接时回退到远程转换
+                        main_yaml = local_job.convert()
+                        main_changed = True
+                    except local_converter.LocalConvertError as e:
+                        logger.warning(f"本地转换不可用，回退到远程转换: {e}")
+                        local_job = None
+                        status_code, response_headers, content_str = _fetch_remote_convert(convert_url)
+                        last_modified = source_last_modified()
+                        main_hash = merge_cache.content_hash(content_str)
+                        cache_key = output_cache_key(main_hash)
+                        cached = cached_response()
+                        if cached is not None:
+                            return cached
 
                 # 处理混合订阅：在覆盖逻辑之前，把 mix_subs 下载到的 proxies 合并进 main_yaml
                 if mix_subs_list:
                     try:
-                        main_yaml_for_mix = yaml.safe_load(content_str)
-                        if not isinstance(main_yaml_for_mix, dict):
+                        if main_yaml is None:
+                            main_yaml = copy.deepcopy(merge_cache.load_yaml(content_str, main_hash))
+                        if not isinstance(main_yaml, dict):
                             logger.error("转换后的主配置不是有效的YAML字典，无法执行 mix_subs 合并")
                             return jsonify({'error': '主配置内容格式错误，无法执行mix_subs合并'}), 500
 
-                        main_proxies_for_mix = main_yaml_for_mix.get('proxies')
+                        main_proxies_for_mix = main_yaml.get('proxies')
                         if not isinstance(main_proxies_for_mix, list):
                             # main_yaml 可能没有 proxies 字段，或者类型不对，统一兜底
                             main_proxies_for_mix = []
-                            main_yaml_for_mix['proxies'] = main_proxies_for_mix
+                            main_yaml['proxies'] = main_proxies_for_mix
 
                         mixed_total = 0
-                        for idx, mix_url in enumerate(mix_subs_list):
+                        for idx, mix_content, mix_hash in mix_contents:
                             try:
-                                mix_content, _, mix_status = subscription_manager.download_subscription(
-                                    mix_url, 'clash-verge/v2.4.3'
-                                )
-                                if mix_content is None:
-                                    logger.warning(f"mix_subs {idx+1} 下载失败，状态码: {mix_status}")
-                                    continue
-
-                                mix_yaml = yaml.safe_load(mix_content)
+                                mix_yaml = merge_cache.load_subscription(mix_content, mix_hash)
                                 if not isinstance(mix_yaml, dict):
                                     logger.warning(f"mix_subs {idx+1} 不是有效的YAML字典")
                                     continue
 
                                 mix_proxies = mix_yaml.get('proxies', [])
                                 if isinstance(mix_proxies, list) and mix_proxies:
-                                    main_proxies_for_mix.extend(mix_proxies)
+                                    # dialers 会修改代理字典，不能直接引用缓存里的对象
+                                    main_proxies_for_mix.extend(copy.deepcopy(mix_proxies))
                                     mixed_total += len(mix_proxies)
                                 else:
                                     logger.warning(f"mix_subs {idx+1} 没有有效的proxies字段")
@@ -334,8 +636,7 @@ def clash_convert():
                                 continue
 
                         if mixed_total > 0:
-                            main_yaml_for_mix['proxies'] = main_proxies_for_mix
-                            content_str = yaml.dump(main_yaml_for_mix, allow_unicode=True, sort_keys=False)
+                            main_changed = True
                             logger.info(f"mix_subs 合并完成，新增 proxies: {mixed_total}，总 proxies: {len(main_proxies_for_mix)}")
                         else:
                             logger.info("mix_subs 未合并到任何 proxies（可能都下载失败或无proxies）")
@@ -344,192 +645,74 @@ def clash_convert():
                         return jsonify({'error': f'mix_subs 合并处理失败: {str(e)}'}), 500
 
                 # 处理覆盖逻辑
-                if cover_url:
+                if cover_content:
                     try:
                         logger.info("开始处理覆盖逻辑...")
-                        # 使用 subscription_manager 下载
-                        cover_content, _, _ = subscription_manager.download_subscription(cover_url, 'clash-verge/v2.4.3')
-                        
-                        if cover_content:
-                            main_yaml = yaml.safe_load(content_str)
-                            cover_yaml = yaml.safe_load(cover_content)
-                            
-                            if isinstance(main_yaml, dict) and isinstance(cover_yaml, dict):
-                                main_groups = main_yaml.get('proxy-groups', [])
-                                cover_groups = cover_yaml.get('proxy-groups', [])
-                                
-                                if isinstance(main_groups, list) and isinstance(cover_groups, list):
-                                    # 创建映射以加快查找
-                                    main_group_map = {g.get('name'): i for i, g in enumerate(main_groups) if isinstance(g, dict) and 'name' in g}
-                                    
-                                    covered_count = 0
-                                    added_count = 0
-                                    for c_group in cover_groups:
-                                        if not isinstance(c_group, dict): continue
-
-                                        # 扩展 proxy-groups.use：按 main_yaml 的 proxy-providers 做全匹配/正则匹配，然后改写 use 列表
-                                        # 规则：use 是 list；每个元素先尝试完全匹配 provider 名，不中则当正则去匹配多个 provider
-                                        # 顺序：按 use 原顺序处理；正则匹配结果按 main_yaml.proxy-providers 的 key 顺序输出；去重保序
-                                        try:
-                                            if 'use' in c_group and isinstance(c_group.get('use'), list):
-                                                providers = main_yaml.get('proxy-providers', {})
-                                                if isinstance(providers, dict) and providers:
-                                                    provider_names = list(providers.keys())
-                                                    new_use = []
-                                                    seen = set()
-                                                    for use_item in c_group.get('use', []):
-                                                        if not isinstance(use_item, str) or not use_item:
-                                                            continue
-
-                                                        # 1) 完全匹配优先
-                                                        if use_item in providers:
-                                                            if use_item not in seen:
-                                                                new_use.append(use_item)
-                                                                seen.add(use_item)
-                                                            continue
-
-                                                        # 2) 正则匹配（合法正则才生效）
-                                                        try:
-                                                            reg = re.compile(use_item)
-                                                        except re.error:
-                                                            logger.warning(f"proxy-group use 项不是合法正则且无完全匹配: {use_item}")
-                                                            continue
-
-                                                        matched_any = False
-                                                        for pname in provider_names:
-                                                            try:
-                                                                if reg.search(pname):
-                                                                    matched_any = True
-                                                                    if pname not in seen:
-                                                                        new_use.append(pname)
-                                                                        seen.add(pname)
-                                                            except Exception:
-                                                                continue
-
-                                                        if not matched_any:
-                                                            logger.warning(f"proxy-group use 正则未匹配到任何 proxy-providers: {use_item}")
-
-                                                    if new_use:
-                                                        c_group['use'] = new_use
-                                                else:
-                                                    logger.warning("main_yaml 没有有效的 proxy-providers，跳过 proxy-group use 改写")
-                                        except Exception as e:
-                                            logger.error(f"处理 proxy-group use 改写时出错: {e}")
-
-                                        c_name = c_group.get('name')
-                                        if c_name:
-                                            if c_name in main_group_map:
-                                                idx = main_group_map[c_name]
-                                                main_groups[idx] = c_group
-                                                covered_count += 1
-                                            else:
-                                                main_groups.append(c_group)
-                                                added_count += 1
-                                    
-                                    if covered_count > 0 or added_count > 0:
-                                        main_yaml['proxy-groups'] = main_groups
-                                        logger.info(f"成功覆盖了 {covered_count} 个, 新增了 {added_count} 个 proxy-groups")
-                                    else:
-                                        logger.info("没有匹配的 proxy-groups 需要处理")
-                                else:
-                                    logger.warning("main_yaml 或 cover_yaml 的 proxy-groups 不是列表")
-                                
-                                # 处理 dialers 字段，给 proxies 添加 dialer-proxy
-                                dialers = cover_yaml.get('dialers', [])
-                                if isinstance(dialers, list) and len(dialers) > 0:
-                                    # name 支持：完全匹配 或 正则表达式匹配
-                                    exact_dialer_map = {}
-                                    regex_dialers = []
-                                    for d in dialers:
-                                        if not (isinstance(d, dict) and 'name' in d and 'dialer-proxy' in d):
-                                            continue
-                                        name_pat = d.get('name')
-                                        dialer_proxy = d.get('dialer-proxy')
-                                        if not isinstance(name_pat, str) or not name_pat:
-                                            continue
-                                        # exact 优先，regex 放列表按顺序匹配
-                                        exact_dialer_map[name_pat] = dialer_proxy
-                                        try:
-                                            regex_dialers.append((name_pat, re.compile(name_pat), dialer_proxy))
-                                        except re.error:
-                                            # 不是合法正则也没关系，照样保留 exact
-                                            pass
-
-                                    if exact_dialer_map or regex_dialers:
-                                        logger.info(f"发现 dialer 配置: exact={len(exact_dialer_map)}, regex={len(regex_dialers)}")
-
-                                        main_proxies = main_yaml.get('proxies', [])
-                                        if not isinstance(main_proxies, list):
-                                            main_proxies = []
-                                            main_yaml['proxies'] = main_proxies
-
-                                        dialer_count = 0
-                                        for proxy in main_proxies:
-                                            if not (isinstance(proxy, dict) and 'name' in proxy):
-                                                continue
-                                            proxy_name = proxy.get('name')
-                                            if not isinstance(proxy_name, str):
-                                                continue
-
-                                            # 1) 完全匹配优先
-                                            if proxy_name in exact_dialer_map:
-                                                proxy['dialer-proxy'] = exact_dialer_map[proxy_name]
-                                                dialer_count += 1
-                                                continue
-
-                                            # 2) 正则匹配（按 cover_yaml 的 dialers 顺序）
-                                            for _, reg, dialer_proxy in regex_dialers:
-                                                try:
-                                                    if reg.search(proxy_name):
-                                                        proxy['dialer-proxy'] = dialer_proxy
-                                                        dialer_count += 1
-                                                        break
-                                                except Exception:
-                                                    continue
-
-                                        if dialer_count > 0:
-                                            main_yaml['proxies'] = main_proxies
-                                            logger.info(f"成功为 {dialer_count} 个代理添加了 dialer-proxy")
-                                
-                                # 重新生成 content_str
-                                content_str = yaml.dump(main_yaml, allow_unicode=True, sort_keys=False)
-                            else:
-                                logger.warning("解析后的 YAML 不是字典")
+                        if main_yaml is None:
+                            main_yaml = copy.deepcopy(merge_cache.load_yaml(content_str, main_hash))
+                        cover_yaml = copy.deepcopy(merge_cache.load_yaml(cover_content))
+
+                        if isinstance(main_yaml, dict) and isinstance(cover_yaml, dict):
+                            _apply_cover(main_yaml, cover_yaml)
+                            main_changed = True
                         else:
-                            logger.warning("cover_url 下载内容为空")
-                            
+                            logger.warning("解析后的 YAML 不是字典")
+
                     except Exception as e:
                         logger.error(f"处理 cover_url 覆盖逻辑时出错: {e}")
+
+                if output_format != 'yaml':
+                    # JSON输出：解析时short-id已保持为字符串，不需要文本修复
+                    if main_yaml is None:
+                        main_yaml = merge_cache.load_yaml(content_str, main_hash)
+                    file_content = fast_output.dump_json(main_yaml, one_item_per_line=output_format == 'json-lines')
+                else:
+                    # 重新生成 content_str
+                    if main_changed:
+                        content_str = fast_output.dump_yaml(main_yaml)
+                    
+                    # 保存到临时文件
+                    with open(temp_filename, 'w', encoding='utf-8') as f:
+                        f.write(content_str)
+                    logger.info(f"内容已保存到临时文件: {temp_filename}")
+                    fix_shortid.fix_short_id(temp_filename,fix_temp_filename)
+                    logger.info(f"short-id修复: {temp_filename}")
+                    # 读取文件内容
+                    with open(fix_temp_filename, 'r', encoding='utf-8') as f:
+                        file_content = f.read()
+                    
+                    # 删除临时文件
+                    os.remove(temp_filename)
+                    os.remove(fix_temp_filename)
+                    logger.info(f"临时文件已删除: {temp_filename}、{fix_temp_filename}")
                 
-                # 保存到临时文件
-                with open(temp_filename, 'w', encoding='utf-8') as f:
-                    f.write(content_str)
-                logger.info(f"内容已保存到临时文件: {temp_filename}")
-                fix_shortid.fix_short_id(temp_filename,fix_temp_filename)
-                logger.info(f"short-id修复: {temp_filename}")
-                # 读取文件内容
-                with open(fix_temp_filename, 'r', encoding='utf-8') as f:
-                    file_content = f.read()
-                
-                # 删除临时文件
-                os.remove(temp_filename)
-                os.remove(fix_temp_filename)
-                logger.info(f"临时文件已删除: {temp_filename}、{fix_temp_filename}")
-                
+            except (subscription_manager.DownloadError, requests.exceptions.RequestException):
+                # 本地转换回退时请求远程转换失败，交给外层按转换请求失败处理
+                raise
             except Exception as e:
                 logger.error(f"文件操作失败: {e}")
                 return jsonify({'error': f'文件操作失败: {str(e)}'}), 500
-            
+
+            body = file_content.encode('utf-8')
+            etag = merge_cache.make_etag(body)
+            if status_code == 200:
+                merge_cache.set_output(cache_key, body, etag)
+
             # 设置文件下载响应头
             response_headers['Content-Type'] = 'application/octet-stream; charset=utf-8'
             response_headers['Content-Disposition'] = 'attachment; filename="clash_sub.yaml"'
             
             # 返回文件内容
-            return Response(
-                file_content.encode('utf-8'),
-                status=response.status_code,
-                headers=response_headers
+            return _conditional_response(
+                body,
+                status_code,
+                response_headers,
+                etag=etag,
+                last_modified=last_modified
             )
+        except subscription_manager.DownloadError as e:
+            logger.error(f"转换结果下载中止: {e}")
+            return jsonify({'error': f'转换结果无效: {str(e)}'}), 502
         except requests.exceptions.RequestException as e:
             logger.error(f"转换请求失败: {e}")
             return jsonify({'error': f'转换请求失败: {str(e)}'}), 500
@@ -565,12 +748,11 @@ def input_page():
             # 优先处理文件上传
             if uploaded_file and uploaded_file.filename:
                 try:
-                    content = uploaded_file.read()
-                    # 尝试解码
-                    try:
-                        yaml_content = content.decode('utf-8')
-                    except UnicodeDecodeError:
-                        yaml_content = content.decode('gbk') # 尝试GBK
+                    content = subscription_manager.read_limited(uploaded_file.stream)
+                    # 和下载订阅使用同样的解码顺序
+                    yaml_content = subscription_manager.decode_content(
+                        content, uploaded_file.mimetype_params.get('charset')
+                    )
                     
                     # 验证YAML格式
                     yaml.safe_load(yaml_content)
@@ -639,6 +821,11 @@ def health_check():
     """健康检查接口"""
     return jsonify({'status': 'ok', 'message': '服务运行正常'})
 
+@app.route('/stats', methods=['GET'])
+def admission_stats():
+    """准入控制统计（当前worker进程）"""
+    return jsonify(admission.stats())
+
 @app.route('/', methods=['GET'])
 def index():
     """首页"""
@@ -646,11 +833,12 @@ def index():
         'service': 'GFW Proxy Helper',
         'version': '1.0.0',
         'endpoints': {
-            '/clash': 'GET - 代理Clash配置请求 (参数: url=key://缓存key|http(s)://直接URL|base64编码的URL, apply_sub=额外订阅URL(同url格式), ua=可选的User-Agent)',
-            '/clash_convert': 'GET - Clash配置转换 (参数: url=base64编码的订阅URL, config=base64编码的配置, convert_url=base64编码的转换服务URL, cover_url=base64编码的覆盖配置URL)',
+            '/clash': 'GET - 代理Clash配置请求 (参数: url=key://缓存key|http(s)://直接URL|base64编码的URL, apply_sub=额外订阅URL(同url格式), ua=可选的User-Agent, format=yaml|json|json-lines)',
+            '/clash_convert': 'GET - Clash配置转换 (参数: url=base64编码的订阅URL, config=base64编码的配置, convert_url=base64编码的转换服务URL, cover_url=base64编码的覆盖配置URL, engine=remote|local转换引擎, include/exclude=节点过滤正则, format=yaml|json|json-lines)',
             '/input': 'GET/POST - 键值对URL存储页面 (POST参数: key=缓存key, url=订阅URL, response_json=true返回json)',
             '/generator': 'GET - Clash参数生成器页面',
-            '/health': 'GET - 健康检查'
+            '/health': 'GET - 健康检查',
+            '/stats': 'GET - 准入控制统计（队列深度、运行中请求数、拒绝次数）'
         }
     })
 
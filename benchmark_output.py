@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import yaml
+
+import fast_output
+import fix_shortid
+
+
+def build_config(proxy_count, rule_count):
+    """生成与真实订阅结构相近的大配置"""
+    rng = random.Random(0)
+    proxies = []
+    for i in range(proxy_count):
+        proxies.append({
+            'name': f"🇭🇰 香港 {i:05d}",
+            'type': 'vless',
+            'server': f"node{i}.example.com",
+            'port': 443,
+            'uuid': f"{rng.getrandbits(128):032x}",
+            'network': 'tcp',
+            'tls': True,
+            'udp': True,
+            'flow': 'xtls-rprx-vision',
+            'servername': 'www.apple.com',
+            'client-fingerprint': 'chrome',
+            'reality-opts': {'public-key': f"{rng.getrandbits(256):064x}", 'short-id': f"{rng.getrandbits(32):08x}"},
+        })
+    names = [p['name'] for p in proxies]
+    return {
+        'port': 7890,
+        'socks-port': 7891,
+        'allow-lan': False,
+        'mode': 'rule',
+        'log-level': 'info',
+        'proxies': proxies,
+        'proxy-groups': [
+            {'name': '🚀 节点选择', 'type': 'select', 'proxies': ['♻️ 自动选择', 'DIRECT'] + names},
+            {'name': '♻️ 自动选择', 'type': 'url-test', 'proxies': names, 'url': 'https://cp.cloudflare.com/generate_204', 'interval': 300},
+        ],
+        'rules': [f"DOMAIN-SUFFIX,site{i}.example.com,🚀 节点选择" for i in range(rule_count)] + ['MATCH,🚀 节点选择'],
+    }
+
+
+def yaml_with_fix(doc):
+    """当前/clash_convert的YAML路径：yaml.dump + 临时文件short-id文本修复"""
+    content = yaml.dump(doc, allow_unicode=True, sort_keys=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        src, dst = os.path.join(tmp, 'a.yaml'), os.path.join(tmp, 'b.yaml')
+        with open(src, 'w', encoding='utf-8') as f:
+            f.write(content)
+        fix_shortid.fix_short_id(src, dst)
+        with open(dst, 'r', encoding='utf-8') as f:
+            return f.read()
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main():
+    proxy_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rule_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    doc = build_config(proxy_count, rule_count)
+    print(f"配置规模: {proxy_count} 个代理, {rule_count} 条规则")
+
+    cases = [
+        ('yaml.dump', lambda: yaml.dump(doc, allow_unicode=True, sort_keys=False)),
+        ('yaml.dump + fix_shortid', lambda: yaml_with_fix(doc)),
+        ('json', lambda: fast_output.dump_json(doc)),
+        ('json-lines', lambda: fast_output.dump_json(doc, one_item_per_line=True)),
+    ]
+    baseline = None
+    for name, func in cases:
+        elapsed, output = timed(func)
+        baseline = baseline or elapsed
+        print(f"{name:<26} {elapsed * 1000:>10.1f} ms  {len(output.encode('utf-8')) / 1024 / 1024:>7.2f} MB  x{baseline / elapsed:.1f}")
+
+        if name.startswith('json'):
+            # 输出必须能被JSON和YAML解析器还原为同一份配置，short-id保持字符串
+            assert json.loads(output) == doc
+            assert yaml.safe_load(output) == doc
+    print("JSON输出与原配置一致，short-id均为字符串")
+
+
+if __name__ == "__main__":
+    main()
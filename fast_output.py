@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# JSON是合法的YAML，Clash内核可以直接解析；用C实现的json编码器代替yaml.dump，大配置快一到两个数量级
+# 键顺序按字典插入顺序输出（等同于yaml.dump的sort_keys=False）
+
+# 支持的输出格式：yaml（默认）、json（紧凑单行）、json-lines（每个代理/分组/规则一行）
+OUTPUT_FORMATS = ('yaml', 'json', 'json-lines')
+
+# 不转换无法表示的值（日期、.nan/.inf等），遇到时整体回退到YAML输出，保证输出和YAML语义一致且可以解析
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+
+
+class NoAliasDumper(yaml.Dumper):
+    """
+    合并结果会引用共享的解析缓存，相同内容的订阅可能出现同一个字典对象；
+    不输出 &id001/*id001 锚点和别名，每个代理都完整展开
+    """
+
+    def ignore_aliases(self, data):
+        return True
+
+
+def dump_yaml(doc):
+    """把配置字典序列化为YAML文本（与原来的yaml.dump参数一致，不输出别名）"""
+    return yaml.dump(doc, Dumper=NoAliasDumper, allow_unicode=True, sort_keys=False)
+
+
+def _with_string_short_ids(proxies):
+    """
+    reality-opts.short-id 必须是字符串；对不是字符串的复制后修正，不修改原对象（可能是共享的解析缓存）
+    """
+    fixed = None
+    for idx, proxy in enumerate(proxies):
+        if not isinstance(proxy, dict):
+            continue
+        reality_opts = proxy.get('reality-opts')
+        if not isinstance(reality_opts, dict):
+            continue
+        short_id = reality_opts.get('short-id')
+        if short_id is None or isinstance(short_id, str):
+            continue
+        if fixed is None:
+            fixed = list(proxies)
+        fixed[idx] = dict(proxy, **{'reality-opts': dict(reality_opts, **{'short-id': str(short_id)})})
+    return proxies if fixed is None else fixed
+
+
+def dump_json(doc, one_item_per_line=False):
+    """
+    把配置字典序列化为JSON文本
+    one_item_per_line=True 时顶层每个键一行，列表/字典类型的值每个元素一行，方便阅读和diff
+    包含JSON无法表示的值（日期、NaN、Infinity等）时回退为YAML文本
+    """
+    if isinstance(doc, dict) and isinstance(doc.get('proxies'), list):
+        doc = dict(doc)
+        doc['proxies'] = _with_string_short_ids(doc['proxies'])
+
+    try:
+        return _encode_json(doc, one_item_per_line)
+    except (TypeError, ValueError) as e:
+        logger.warning(f"配置包含JSON无法表示的值，改为YAML输出: {e}")
+        return dump_yaml(doc)
+
+
+def _encode_json(doc, one_item_per_line):
+    if not one_item_per_line or not isinstance(doc, dict):
+        return _encoder.encode(doc) + '\n'
+
+    encode = _encoder.encode
+    parts = []
+    for key, value in doc.items():
+        key_json = encode(str(key))
+        if isinstance(value, list) and value:
+            items = ',\n'.join(map(encode, value))
+            parts.append(f'{key_json}:[\n{items}\n]')
+        elif isinstance(value, dict) and value:
+            items = ',\n'.join(f'{encode(str(k))}:{encode(v)}' for k, v in value.items())
+            parts.append(f'{key_json}:{{\n{items}\n}}')
+        else:
+            parts.append(f'{key_json}:{encode(value)}')
+    return '{\n' + ',\n'.join(parts) + '\n}\n'
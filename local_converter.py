@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import copy
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import unquote, urlparse
+
+import requests
+
+import merge_cache
+import subscription_manager
+
+logger = logging.getLogger(__name__)
+
+# 本地转换引擎：对Clash YAML或分享链接订阅，按subconverter外部配置(.ini)在本地生成与远程转换服务同形状的配置
+
+# 获取当前脚本所在目录
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')
+CONFIG_CACHE_DIR = os.path.join(CACHE_DIR, 'convert_config')
+
+# .ini配置在内存中的有效期（秒），过期后重新下载，下载失败继续使用旧配置
+CONFIG_TTL = int(os.environ.get('LOCAL_CONVERT_CONFIG_TTL', '21600'))
+
+# 与远程subconverter默认输出一致的基础配置
+BASE_CONFIG = {
+    'port': 7890,
+    'socks-port': 7891,
+    'allow-lan': False,
+    'mode': 'rule',
+    'log-level': 'info',
+    'external-controller': ':9090',
+}
+
+# subconverter默认emoji规则（按顺序匹配第一个）
+DEFAULT_EMOJI_RULES = [
+    (r'(流量|时间|应用|过期|到期|剩余|官网|产品|平台)', '🏳️‍🌈'),
+    (r'(?i:\bHK[G]?\b|Hong.*?Kong|\bHKT\b|\bHKBN\b|\bHGC\b|\bWTT\b|\bCMI\b|[^-]港|^港)', '🇭🇰'),
+    (r'(?i:\bTW[N]?\b|Taiwan|新北|彰化|\bCHT\b|台湾|台灣|\bHINET\b)', '🇹🇼'),
+    (r'(?i:\bSG[P]?\b|Singapore|新加坡|狮城|[^-]新$)', '🇸🇬'),
+    (r'(?i:\bJP[N]?\b|Japan|Tokyo|Osaka|Saitama|东京|大阪|埼玉|日本)', '🇯🇵'),
+    (r'(?i:\bK[O]?R\b|Korea|首尔|韩|韓)', '🇰🇷'),
+    (r'(?i:\bUS[A]?\b|America|United.*?States|美国|波特兰|达拉斯|俄勒冈|凤凰城|费利蒙|硅谷|拉斯维加斯|洛杉矶|圣何塞|圣克拉拉|西雅图|芝加哥)', '🇺🇸'),
+    (r'(?i:\bUK\b|\bGB\b|England|United.*?Kingdom|英国|伦敦)', '🇬🇧'),
+    (r'(?i:\bDE\b|German|GERMAN|德国|法兰克福)', '🇩🇪'),
+    (r'(?i:\bFR\b|France|法国|巴黎)', '🇫🇷'),
+    (r'(?i:\bNL\b|Netherlands|荷兰|阿姆斯特丹)', '🇳🇱'),
+    (r'(?i:\bCA\b|Canada|加拿大|蒙特利尔|温哥华|多伦多)', '🇨🇦'),
+    (r'(?i:\bAU\b|Australia|澳大利亚|澳洲|悉尼)', '🇦🇺'),
+    (r'(?i:\bRU\b|Russia|俄罗斯|莫斯科|伯力|海参崴)', '🇷🇺'),
+    (r'(?i:\bIN\b|India|印度|孟买)', '🇮🇳'),
+    (r'(?i:\bTR\b|Turkey|土耳其|伊斯坦布尔)', '🇹🇷'),
+    (r'(?i:\bMY\b|Malaysia|马来西亚|吉隆坡)', '🇲🇾'),
+    (r'(?i:\bTH\b|Thailand|泰国|曼谷)', '🇹🇭'),
+    (r'(?i:\bVN\b|Vietnam|越南)', '🇻🇳'),
+    (r'(?i:\bPH\b|Philippines|菲律宾)', '🇵🇭'),
+    (r'(?i:\bID\b|Indonesia|印尼|印度尼西亚|雅加达)', '🇮🇩'),
+    (r'(?i:\bAR\b|Argentina|阿根廷)', '🇦🇷'),
+    (r'(?i:\bBR\b|Brazil|巴西)', '🇧🇷'),
+    (r'(?i:\bCN\b|China|回国|中国|江苏|北京|上海|广州|深圳|杭州|常州|徐州|青岛|宁波|镇江|back)', '🇨🇳'),
+]
+
+# 开头的国旗/emoji（remove_old_emoji时去掉）
+OLD_EMOJI_PATTERN = re.compile(r'^(?:[\U0001F1E6-\U0001F1FF]{2}|[\U0001F300-\U0001FAFF\u2600-\u27BF]\uFE0F?(?:\u200D[\U0001F300-\U0001FAFF\u2600-\u27BF]\uFE0F?)*)\s*')
+
+# 需要跳过证书验证(scv)的带TLS代理类型
+TLS_PROXY_TYPES = {'vmess', 'vless', 'trojan', 'hysteria', 'hysteria2', 'tuic', 'anytls'}
+
+# fdn：过滤Clash内核不支持的ss加密方式
+DEPRECATED_SS_CIPHERS = {'rc4', 'bf-cfb', 'cast5-cfb', 'des-cfb', 'idea-cfb', 'rc2-cfb', 'seed-cfb', 'salsa20'}
+
+# url-test等分组最后一段的 interval,timeout,tolerance
+GROUP_TIMING_PATTERN = re.compile(r'^\d*(,\d*){0,2}$')
+
+RULE_PROVIDER_PREFIXES = {
+    'clash-domain:': ('domain', 'yaml'),
+    'clash-ipcidr:': ('ipcidr', 'yaml'),
+    'clash-classic:': ('classical', 'yaml'),
+    'surge:': ('classical', 'text'),
+    'quanx:': ('classical', 'text'),
+}
+
+
+class LocalConvertError(Exception):
+    """本地转换无法处理，调用方应回退到远程转换"""
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern):
+    """预编译节点过滤/匹配正则，非法正则抛出LocalConvertError"""
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise LocalConvertError(f"非法正则 {pattern}: {e}")
+
+
+def parse_config(text):
+    """
+    解析subconverter外部配置(.ini)，返回预处理后的配置字典
+    正则在这里一次性编译，转换时直接使用
+    """
+    config = {
+        'rulesets': [],
+        'groups': [],
+        'rename': [],
+        'emoji': [],
+        'include_remarks': [],
+        'exclude_remarks': [],
+        'add_emoji': None,
+        'remove_old_emoji': None,
+        'enable_rule_generator': True,
+    }
+    provider_names = set()
+
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line or line.startswith((';', '#', '//', '[')) or '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        key = key.strip()
+        value = value.strip()
+
+        if key in ('ruleset', 'surge_ruleset'):
+            if ',' not in value:
+                logger.warning(f"忽略无效ruleset: {value}")
+                continue
+            group, source = value.split(',', 1)
+            config['rulesets'].append(_parse_ruleset(group.strip(), source.strip(), provider_names))
+        elif key == 'custom_proxy_group':
+            group = _parse_proxy_group(value)
+            if group:
+                config['groups'].append(group)
+        elif key == 'rename':
+            if '@' not in value:
+                continue
+            pattern, replacement = value.split('@', 1)
+            config['rename'].append((compile_pattern(pattern), replacement))
+        elif key == 'emoji':
+            if ',' not in value:
+                continue
+            pattern, emoji = value.rsplit(',', 1)
+            config['emoji'].append((compile_pattern(pattern), emoji))
+        elif key in ('include_remarks', 'exclude_remarks'):
+            config[key].append(compile_pattern(value))
+        elif key in ('add_emoji', 'remove_old_emoji', 'enable_rule_generator'):
+            config[key] = value.lower() == 'true'
+
+    if not config['emoji']:
+        config['emoji'] = [(compile_pattern(p), e) for p, e in DEFAULT_EMOJI_RULES]
+
+    return config
+
+
+def _parse_ruleset(group, source, provider_names):
+    """解析 ruleset=分组,[]内联规则 或 ruleset=分组,[前缀:]URL[,更新间隔]"""
+    if source.startswith('[]'):
+        return {'group': group, 'inline': source[2:]}
+
+    interval = 86400
+    url = source
+    head, sep, tail = source.rpartition(',')
+    if sep and tail.isdigit():
+        url, interval = head, int(tail)
+
+    behavior, fmt = 'classical', 'text'
+    for prefix, (prefix_behavior, prefix_fmt) in RULE_PROVIDER_PREFIXES.items():
+        if url.startswith(prefix):
+            url = url[len(prefix):]
+            behavior, fmt = prefix_behavior, prefix_fmt
+            break
+
+    # provider名取文件名（不含扩展名），重名时加序号
+    stem = os.path.splitext(os.path.basename(unquote(urlparse(url).path)))[0] or 'ruleset'
+    name = stem
+    seq = 2
+    while name in provider_names:
+        name = f"{stem}_{seq}"
+        seq += 1
+    provider_names.add(name)
+
+    return {
+        'group': group,
+        'provider': name,
+        'url': url,
+        'behavior': behavior,
+        'format': fmt,
+        'interval': interval,
+    }
+
+
+def _parse_proxy_group(value):
+    """解析 custom_proxy_group=名称`类型`规则...[`测速URL`interval,timeout,tolerance]"""
+    parts = value.split('`')
+    if len(parts) < 3:
+        logger.warning(f"忽略无效custom_proxy_group: {value}")
+        return None
+
+    name, group_type, items = parts[0], parts[1], parts[2:]
+    group = {'name': name, 'type': group_type, 'matchers': [], 'use': []}
+
+    if group_type in ('url-test', 'fallback', 'load-balance'):
+        if items and GROUP_TIMING_PATTERN.match(items[-1]):
+            interval, timeout, tolerance = (items.pop().split(',') + ['', ''])[:3]
+            group['interval'] = int(interval) if interval else 300
+            if timeout:
+                group['timeout'] = int(timeout)
+            if tolerance:
+                group['tolerance'] = int(tolerance)
+        if items and re.match(r'^https?://', items[-1]):
+            group['url'] = items.pop()
+
+    for item in items:
+        if not item:
+            continue
+        if item.startswith('[]'):
+            group['matchers'].append(('literal', item[2:]))
+        elif item.startswith('!!PROVIDER='):
+            group['use'].extend(p for p in item[len('!!PROVIDER='):].split(',') if p)
+        elif item.startswith('!!'):
+            logger.warning(f"本地转换不支持的分组规则，已忽略: {item}")
+        else:
+            try:
+                group['matchers'].append(('regex', compile_pattern(item)))
+            except LocalConvertError as e:
+                logger.warning(f"分组 {name} 的规则无效，已忽略: {e}")
+    return group
+
+
+_config_cache = {}
+_config_lock = threading.Lock()
+
+
+def _read_disk_config(disk_path):
+    # newline=''保留原始换行，和下载内容逐字比较
+    try:
+        with open(disk_path, 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def load_config(config_url):
+    """
+    获取解析后的.ini配置（内存缓存CONFIG_TTL秒，磁盘保留最后一次成功下载的原文）
+    返回 (config, content_sha, changed_at)
+    changed_at取磁盘原文的修改时间，只在内容变化时重写，所有worker和重启前后一致
+    """
+    now = time.time()
+    with _config_lock:
+        entry = _config_cache.get(config_url)
+    if entry and now - entry['fetched'] < CONFIG_TTL:
+        return entry['config'], entry['sha'], entry['changed_at']
+
+    disk_path = os.path.join(CONFIG_CACHE_DIR, hashlib.sha256(config_url.encode('utf-8')).hexdigest() + '.ini')
+    try:
+        logger.info(f"下载转换配置: {config_url}")
+        status_code, _, text = subscription_manager.fetch_text(config_url, timeout=30)
+        if status_code != 200:
+            raise LocalConvertError(f"转换配置下载失败，状态码: {status_code}")
+        if _read_disk_config(disk_path) != text:
+            os.makedirs(CONFIG_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{disk_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+            os.replace(tmp_path, disk_path)
+    except (requests.exceptions.RequestException, subscription_manager.DownloadError, LocalConvertError) as e:
+        if entry:
+            logger.warning(f"转换配置更新失败，继续使用旧配置: {e}")
+            entry['fetched'] = now
+            return entry['config'], entry['sha'], entry['changed_at']
+        text = _read_disk_config(disk_path)
+        if text is None:
+            raise LocalConvertError(f"无法获取转换配置: {e}")
+        logger.warning(f"转换配置下载失败，使用磁盘缓存: {e}")
+
+    changed_at = datetime.fromtimestamp(int(os.path.getmtime(disk_path)), timezone.utc)
+    sha = merge_cache.content_hash(text)
+    if entry and entry['sha'] == sha:
+        config = entry['config']
+    else:
+        config = parse_config(text)
+        logger.info(f"转换配置已解析: {len(config['groups'])} 个分组, {len(config['rulesets'])} 条ruleset")
+
+    with _config_lock:
+        _config_cache[config_url] = {'fetched': now, 'sha': sha, 'config': config, 'changed_at': changed_at}
+    return config, sha, changed_at
+
+
+class LocalConvertJob:
+    """
+    一次本地转换：prepare阶段下载所有来源和配置，convert阶段才解析来源并生成配置
+    key只由各来源内容哈希、配置哈希和选项组成，输出缓存命中或304时不需要解析YAML
+    """
+
+    def __init__(self, source_urls, sources, subscription_userinfo, config, config_sha, config_changed_at, include, exclude):
+        self.source_urls = source_urls
+        # [(原文, 内容哈希)]
+        self.sources = sources
+        self._parsed_sources = None
+        self.subscription_userinfo = subscription_userinfo
+        self.config = config
+        self.config_changed_at = config_changed_at
+        self.include = include
+        self.exclude = exclude
+        self.key = merge_cache.build_key(
+            'local_convert',
+            *[sha for _, sha in sources],
+            config=config_sha,
+            include=include,
+            exclude=exclude
+        )
+
+    def parse_sources(self):
+        """
+        解析所有来源（内容未变化时复用解析缓存）
+        任何来源既不是Clash YAML也不是分享链接列表都抛出LocalConvertError，由调用方回退到远程转换
+        """
+        if self._parsed_sources is None:
+            parsed_sources = []
+            for idx, (content, sha) in enumerate(self.sources):
+                try:
+                    parsed = merge_cache.load_subscription(content, sha)
+                except Exception as e:
+                    raise LocalConvertError(f"订阅 {idx+1} 解析失败: {e}")
+                if not isinstance(parsed, dict) or not isinstance(parsed.get('proxies'), list):
+                    raise LocalConvertError(f"订阅 {idx+1} 不是Clash YAML或分享链接列表")
+                parsed_sources.append(parsed)
+            self._parsed_sources = parsed_sources
+        return self._parsed_sources
+
+    def convert(self):
+        """生成完整配置字典（新对象，调用方可以直接修改）；来源无法解析时抛出LocalConvertError"""
+        parsed_sources = self.parse_sources()
+        proxies, first_renames = self._build_proxies(parsed_sources)
+        names = [p['name'] for p in proxies]
+
+        result = dict(BASE_CONFIG)
+        result['proxies'] = proxies
+
+        if not self.config['enable_rule_generator']:
+            # 不生成规则时沿用第一个订阅的分组和规则（来源是共享的解析缓存，深复制后再修改）
+            first = parsed_sources[0]
+            for field in ('proxy-groups', 'rules', 'rule-providers'):
+                if field in first:
+                    result[field] = copy.deepcopy(first[field])
+            if isinstance(result.get('proxy-groups'), list):
+                self._rename_group_members(result['proxy-groups'], first, first_renames)
+            return result
+
+        result['proxy-groups'] = [self._build_group(g, names) for g in self.config['groups']]
+
+        providers = {}
+        rules = []
+        for ruleset in self.config['rulesets']:
+            if 'inline' in ruleset:
+                rule = _inline_rule(ruleset['inline'], ruleset['group'])
+                if rule:
+                    rules.append(rule)
+                continue
+            providers[ruleset['provider']] = {
+                'type': 'http',
+                'behavior': ruleset['behavior'],
+                'format': ruleset['format'],
+                'url': ruleset['url'],
+                'path': f"./providers/rule-provider_{ruleset['provider']}.yaml",
+                'interval': ruleset['interval'],
+            }
+            rules.append(f"RULE-SET,{ruleset['provider']},{ruleset['group']}")
+
+        if providers:
+            result['rule-providers'] = providers
+        result['rules'] = rules
+        return result
+
+    @staticmethod
+    def _rename_group_members(groups, first, renames):
+        """
+        沿用的分组里节点名改成重命名后的名字，被过滤掉的节点从分组中移除
+        其他成员（分组名、DIRECT/REJECT等）保持不变
+        """
+        source_names = {p['name'] for p in first.get('proxies') or []
+                        if isinstance(p, dict) and isinstance(p.get('name'), str)}
+        for group in groups:
+            if not isinstance(group, dict) or not isinstance(group.get('proxies'), list):
+                continue
+            members = []
+            for member in group['proxies']:
+                if member in renames:
+                    members.append(renames[member])
+                elif member not in source_names:
+                    members.append(member)
+            if not members and not group.get('use'):
+                members = ['DIRECT']
+            group['proxies'] = members
+
+    def _build_proxies(self, parsed_sources):
+        """
+        过滤、重命名、添加emoji，并按远程转换的默认参数(udp/scv/fdn)处理节点
+        返回 (节点列表, 第一个订阅的 原名->新名 映射)
+        """
+        include = compile_pattern(self.include) if self.include else None
+        exclude = compile_pattern(self.exclude) if self.exclude else None
+        include_remarks = self.config['include_remarks']
+        exclude_remarks = self.config['exclude_remarks']
+        rename_rules = self.config['rename']
+        emoji_rules = self.config['emoji']
+        add_emoji = self.config['add_emoji'] is not False
+        remove_old_emoji = self.config['remove_old_emoji'] is not False
+
+        proxies = []
+        seen_names = set()
+        first_renames = {}
+        for source_idx, parsed in enumerate(parsed_sources):
+            for proxy in parsed.get('proxies') or []:
+                if not isinstance(proxy, dict) or not isinstance(proxy.get('name'), str):
+                    continue
+                name = proxy['name']
+
+                if include and not include.search(name):
+                    continue
+                if exclude and exclude.search(name):
+                    continue
+                if include_remarks and not any(p.search(name) for p in include_remarks):
+                    continue
+                if any(p.search(name) for p in exclude_remarks):
+                    continue
+                if proxy.get('type') == 'ss' and str(proxy.get('cipher', '')).lower() in DEPRECATED_SS_CIPHERS:
+                    continue
+
+                for pattern, replacement in rename_rules:
+                    name = pattern.sub(replacement, name)
+                if remove_old_emoji:
+                    name = OLD_EMOJI_PATTERN.sub('', name)
+                if add_emoji:
+                    for pattern, emoji in emoji_rules:
+                        if pattern.search(name):
+                            name = f"{emoji} {name}"
+                            break
+
+                # Clash要求节点名唯一
+                unique_name = name
+                seq = 2
+                while unique_name in seen_names:
+                    unique_name = f"{name} {seq}"
+                    seq += 1
+                seen_names.add(unique_name)
+                if source_idx == 0:
+                    first_renames.setdefault(proxy['name'], unique_name)
+
+                # 来源是共享的解析缓存，复制后再修改
+                new_proxy = dict(proxy)
+                new_proxy['name'] = unique_name
+                new_proxy['udp'] = True
+                if new_proxy.get('type') in TLS_PROXY_TYPES:
+                    new_proxy['skip-cert-verify'] = True
+                proxies.append(new_proxy)
+
+        return proxies, first_renames
+
+    def _build_group(self, group, names):
+        members = []
+        seen = set()
+        for kind, matcher in group['matchers']:
+            if kind == 'literal':
+                candidates = [matcher]
+            else:
+                candidates = [n for n in names if matcher.search(n)]
+            for candidate in candidates:
+                if candidate not in seen:
+                    seen.add(candidate)
+                    members.append(candidate)
+
+        result = {'name': group['name'], 'type': group['type']}
+        if group['use']:
+            result['use'] = list(group['use'])
+        if not members and not group['use']:
+            members = ['DIRECT']
+        if members:
+            result['proxies'] = members
+        for field in ('url', 'interval', 'timeout', 'tolerance'):
+            if field in group:
+                result[field] = group[field]
+        return result
+
+
+def _inline_rule(inline, group):
+    """[]GEOIP,CN,no-resolve -> GEOIP,CN,分组,no-resolve；[]FINAL -> MATCH,分组"""
+    parts = [p.strip() for p in inline.split(',')]
+    if parts[0] in ('FINAL', 'MATCH'):
+        return f"MATCH,{group}"
+    if len(parts) < 2:
+        logger.warning(f"忽略无效内联规则: {inline}")
+        return None
+    return ','.join(parts[:2] + [group] + parts[2:])
+
+
+def prepare(url, config_url, ua='clash-verge/v2.4.3', include='', exclude=''):
+    """
+    下载所有来源（url可用|分隔多个，支持key://、http(s)://、base64）并获取.ini配置
+    来源在LocalConvertJob.convert时才解析；下载或配置失败时抛出LocalConvertError，由调用方回退到远程转换
+    """
+    if not config_url.startswith(('http://', 'https://')):
+        raise LocalConvertError(f"不支持的配置地址: {config_url}")
+
+    source_urls = [u for u in url.split('|') if u]
+    if not source_urls:
+        raise LocalConvertError("缺少订阅地址")
+
+    sources = []
+    subscription_userinfo = ''
+    for idx, source_url in enumerate(source_urls):
+        content, userinfo, status = subscription_manager.download_subscription(source_url, ua)
+        if content is None:
+            raise LocalConvertError(f"订阅 {idx+1} 下载失败，状态码: {status}")
+        if idx == 0:
+            subscription_userinfo = userinfo or ''
+        sources.append((content, merge_cache.content_hash(content)))
+
+    # 过滤正则也提前编译，非法时直接回退
+    for pattern in (include, exclude):
+        if pattern:
+            compile_pattern(pattern)
+
+    config, config_sha, config_changed_at = load_config(config_url)
+    return LocalConvertJob(source_urls, sources, subscription_userinfo, config, config_sha, config_changed_at, include, exclude)
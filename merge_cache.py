@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import subscription_manager
+
+logger = logging.getLogger(__name__)
+
+# 解析结果缓存条目数（按订阅内容哈希）
+PARSED_CACHE_SIZE = int(os.environ.get('MERGE_PARSED_CACHE_SIZE', '64'))
+# 合并输出缓存条目数（按各组件内容哈希+合并选项）
+OUTPUT_CACHE_SIZE = int(os.environ.get('MERGE_OUTPUT_CACHE_SIZE', '32'))
+
+# 合并输出的磁盘缓存，所有worker进程共享（预热调度器只在一个进程里运行，结果要让其他进程也能用上）
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_DISK_DIR = os.path.join(BASE_DIR, 'cache', 'output')
+OUTPUT_DISK_MAX = int(os.environ.get('MERGE_OUTPUT_DISK_MAX', '64'))
+
+
+class LRUCache:
+    """线程安全的简单LRU缓存"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+parsed_cache = LRUCache(PARSED_CACHE_SIZE)
+output_cache = LRUCache(OUTPUT_CACHE_SIZE)
+
+
+def content_hash(content):
+    """计算订阅内容的sha256哈希"""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def build_key(route, *component_hashes, **options):
+    """
+    由路由名、各组件内容哈希和合并选项生成输出缓存key
+    组件顺序有意义（合并结果按顺序追加proxies）
+    """
+    payload = json.dumps([route, component_hashes, options], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _load_cached(kind, parser, content, content_sha):
+    """按内容哈希缓存解析结果，kind区分不同的解析方式"""
+    if content_sha is None:
+        content_sha = content_hash(content)
+    cache_key = (kind, content_sha)
+    cached = parsed_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"复用已解析的订阅: {content_sha[:12]}")
+        return cached
+
+    parsed = parser(content)
+    parsed_cache.set(cache_key, parsed)
+    return parsed
+
+
+def load_yaml(content, content_sha=None):
+    """
+    解析YAML并按内容哈希缓存解析结果
+    返回的对象是共享的，调用方需要修改时必须自行复制
+    """
+    return _load_cached('yaml', subscription_manager.load_yaml_text, content, content_sha)
+
+
+def load_subscription(content, content_sha=None):
+    """
+    解析订阅（Clash YAML 或 base64/明文分享链接列表）并按内容哈希缓存解析结果
+    返回的对象是共享的，调用方需要修改时必须自行复制
+    """
+    return _load_cached('subscription', subscription_manager.parse_subscription, content, content_sha)
+
+
+def make_etag(body):
+    """由响应体内容生成强ETag（带引号）"""
+    return f'"{content_hash(body)}"'
+
+
+def get_output(cache_key):
+    """读取合并输出缓存：先查进程内LRU，再查磁盘"""
+    cached = output_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    path = os.path.join(OUTPUT_DISK_DIR, f"{cache_key}.body")
+    try:
+        with open(path, 'rb') as f:
+            body = f.read()
+    except OSError:
+        return None
+    cached = {'body': body, 'etag': make_etag(body)}
+    output_cache.set(cache_key, cached)
+    return cached
+
+
+def set_output(cache_key, body, etag):
+    """保存合并输出到进程内LRU和磁盘，磁盘只保留最近的OUTPUT_DISK_MAX个"""
+    output_cache.set(cache_key, {'body': body, 'etag': etag})
+    try:
+        os.makedirs(OUTPUT_DISK_DIR, exist_ok=True)
+        path = os.path.join(OUTPUT_DISK_DIR, f"{cache_key}.body")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+        files = [os.path.join(OUTPUT_DISK_DIR, name) for name in os.listdir(OUTPUT_DISK_DIR) if name.endswith('.body')]
+        if len(files) > OUTPUT_DISK_MAX:
+            files.sort(key=lambda p: os.path.getmtime(p))
+            for old_path in files[:len(files) - OUTPUT_DISK_MAX]:
+                os.remove(old_path)
+    except OSError as e:
+        logger.error(f"保存合并输出磁盘缓存失败: {e}")
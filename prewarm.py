@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fcntl
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from flask import request
+
+import subscription_manager
+
+logger = logging.getLogger(__name__)
+
+# 预热调度：记录客户端轮询的 /clash、/clash_convert 参数和 try_update key，
+# 按观察到的轮询间隔在下次轮询前提前请求一遍，结果写入所有worker共享的预热缓存和合并输出磁盘缓存
+PREWARM_ENABLED = os.environ.get('PREWARM_ENABLED', 'true').lower() == 'true'
+# 在预计轮询时间之前多少秒开始预热，再随机提前0~JITTER秒，避免同一时刻集中请求上游
+PREWARM_LEAD_SECONDS = int(os.environ.get('PREWARM_LEAD_SECONDS', '120'))
+PREWARM_JITTER_SECONDS = int(os.environ.get('PREWARM_JITTER_SECONDS', '60'))
+# 同时进行的预热任务上限（全局，调度器只在一个进程里运行）
+PREWARM_CONCURRENCY = int(os.environ.get('PREWARM_CONCURRENCY', '2'))
+# 轮询间隔短于这个值（秒）的不预热，普通缓存已经能覆盖
+PREWARM_MIN_INTERVAL = int(os.environ.get('PREWARM_MIN_INTERVAL', '600'))
+# 超过这个时间（秒）没有再轮询的条目从登记表移除
+PREWARM_EXPIRE_SECONDS = int(os.environ.get('PREWARM_EXPIRE_SECONDS', str(3 * 86400)))
+PREWARM_TICK_SECONDS = 30
+# 同一条目在这个时间（秒）内的多次请求算作一次轮询（客户端重试、多个worker）
+POLL_DEDUP_SECONDS = 60
+MAX_POLLS = 8
+
+PREWARM_ROUTES = {'clash_proxy', 'clash_convert'}
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')
+REGISTRY_FILE = os.path.join(CACHE_DIR, 'prewarm_registry.json')
+REGISTRY_LOCK_FILE = os.path.join(CACHE_DIR, 'prewarm_registry.lock')
+SCHEDULER_LOCK_FILE = os.path.join(CACHE_DIR, 'prewarm_scheduler.lock')
+
+_app = None
+# 本进程最近一次登记各条目的时间，去重窗口内不再读写登记表（避免热路径上争抢文件锁）
+_recent_records = {}
+_recent_lock = threading.Lock()
+
+
+@contextmanager
+def _registry_locked():
+    """登记表在多个worker进程间共享，读写时加文件锁"""
+    with open(REGISTRY_LOCK_FILE, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_registry():
+    try:
+        with open(REGISTRY_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_registry(registry):
+    tmp_path = f"{REGISTRY_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(registry, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, REGISTRY_FILE)
+
+
+def record(kind, target, **extra):
+    """登记一次客户端轮询；kind为route（target是请求路径+参数）或key（target是try_update的key）"""
+    now = time.time()
+    entry_id = f"{kind} {target} {extra.get('ua', '')}".rstrip()
+    with _recent_lock:
+        if now - _recent_records.get(entry_id, 0) < POLL_DEDUP_SECONDS:
+            return
+        _recent_records[entry_id] = now
+        if len(_recent_records) > 10000:
+            for key, recorded_at in list(_recent_records.items()):
+                if now - recorded_at >= POLL_DEDUP_SECONDS:
+                    del _recent_records[key]
+    with _registry_locked():
+        registry = _load_registry()
+        entry = registry.get(entry_id) or {'kind': kind, 'target': target, 'polls': [], 'warmed_at': 0}
+        if entry['polls'] and now - entry['polls'][-1] < POLL_DEDUP_SECONDS:
+            return
+        entry.update(extra)
+        entry['polls'] = (entry['polls'] + [now])[-MAX_POLLS:]
+        registry[entry_id] = entry
+        _save_registry(registry)
+
+
+def _mark_warmed(entry_id):
+    with _registry_locked():
+        registry = _load_registry()
+        if entry_id in registry:
+            registry[entry_id]['warmed_at'] = time.time()
+            _save_registry(registry)
+
+
+def next_warm_time(entry_id, entry, now):
+    """
+    按最近几次轮询间隔的中位数推算下次轮询时间，返回应该开始预热的时间
+    轮询次数不足或间隔太短时返回None
+    """
+    polls = entry.get('polls', [])
+    intervals = sorted(b - a for a, b in zip(polls, polls[1:]) if b - a >= POLL_DEDUP_SECONDS)
+    if not intervals:
+        return None
+    interval = intervals[len(intervals) // 2]
+    if interval < PREWARM_MIN_INTERVAL:
+        return None
+
+    next_poll = polls[-1] + interval
+    while next_poll < now:
+        next_poll += interval
+    # 同一次轮询的抖动固定，不会每个tick变化
+    jitter = random.Random(f"{entry_id} {int(next_poll)}").uniform(0, PREWARM_JITTER_SECONDS)
+    return next_poll - PREWARM_LEAD_SECONDS - jitter
+
+
+def _warm(entry_id, entry):
+    """执行一次预热：重放请求或更新key，结果由下载/合并流程写入共享缓存"""
+    started = time.time()
+    try:
+        with subscription_manager.prewarming():
+            if entry['kind'] == 'route':
+                response = _app.test_client().get(entry['target'])
+                result = response.status_code
+            else:
+                _, _, result = subscription_manager.download_subscription(
+                    f"key://{entry['target']}", entry.get('ua') or 'clash-verge/v2.4.3'
+                )
+        logger.info(f"预热完成: {entry_id}，结果: {result}，耗时 {time.time() - started:.1f}s")
+    except Exception as e:
+        logger.error(f"预热失败: {entry_id}: {e}")
+    finally:
+        _mark_warmed(entry_id)
+
+
+def _prune_prewarm_dir(now):
+    """删除已经过期很久的预热结果文件"""
+    try:
+        for name in os.listdir(subscription_manager.PREWARM_DIR):
+            path = os.path.join(subscription_manager.PREWARM_DIR, name)
+            if now - os.path.getmtime(path) > max(86400, subscription_manager.PREWARM_FRESH_SECONDS):
+                os.remove(path)
+    except OSError:
+        pass
+
+
+def _run_scheduler():
+    executor = ThreadPoolExecutor(max_workers=PREWARM_CONCURRENCY, thread_name_prefix='prewarm')
+    in_flight = set()
+    in_flight_lock = threading.Lock()
+
+    def done(entry_id):
+        with in_flight_lock:
+            in_flight.discard(entry_id)
+
+    while True:
+        try:
+            now = time.time()
+            with _registry_locked():
+                registry = _load_registry()
+                expired = [k for k, e in registry.items() if not e.get('polls') or now - e['polls'][-1] > PREWARM_EXPIRE_SECONDS]
+                for entry_id in expired:
+                    del registry[entry_id]
+                if expired:
+                    _save_registry(registry)
+                    logger.info(f"预热登记表移除 {len(expired)} 个过期条目")
+
+            for entry_id, entry in registry.items():
+                warm_at = next_warm_time(entry_id, entry, now)
+                if warm_at is None or now < warm_at or entry.get('warmed_at', 0) >= warm_at:
+                    continue
+                with in_flight_lock:
+                    if entry_id in in_flight:
+                        continue
+                    in_flight.add(entry_id)
+                logger.info(f"开始预热: {entry_id}")
+                future = executor.submit(_warm, entry_id, entry)
+                future.add_done_callback(lambda _, entry_id=entry_id: done(entry_id))
+
+            _prune_prewarm_dir(now)
+        except Exception as e:
+            logger.error(f"预热调度出错: {e}")
+        time.sleep(PREWARM_TICK_SECONDS)
+
+
+def _scheduler_main():
+    """多个worker进程都会启动这个线程，只有拿到文件锁的进程运行调度器；持有者退出后由其他进程接管"""
+    while True:
+        lock_file = open(SCHEDULER_LOCK_FILE, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            time.sleep(60)
+            continue
+        logger.info(f"预热调度器在进程 {os.getpid()} 中启动")
+        _run_scheduler()
+
+
+def _before_request():
+    # 清掉同一线程上一次请求遗留的记录
+    subscription_manager.pop_try_update_keys()
+
+
+def _worth_warming():
+    """只读本地key://缓存（没有try_update）的/clash请求不需要预热"""
+    if request.endpoint == 'clash_proxy':
+        sources = [request.args.get('url', '')] + request.args.getlist('apply_sub')
+        if all(source.startswith('key://') for source in sources):
+            return subscription_manager.has_try_update(sources)
+    return True
+
+
+def _after_request(response):
+    """客户端成功轮询后登记，预热请求本身不登记"""
+    if subscription_manager.is_prewarming():
+        return response
+    try_update_keys = subscription_manager.pop_try_update_keys()
+    if request.endpoint in PREWARM_ROUTES and response.status_code in (200, 304) and _worth_warming():
+        try:
+            record('route', request.full_path)
+            for key_name, ua in try_update_keys:
+                record('key', key_name, ua=ua)
+        except Exception as e:
+            logger.error(f"登记预热条目失败: {e}")
+    return response
+
+
+def init_app(app):
+    """注册轮询登记钩子并启动调度线程"""
+    global _app
+    if not PREWARM_ENABLED:
+        return
+    _app = app
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    threading.Thread(target=_scheduler_main, name='prewarm-scheduler', daemon=True).start()
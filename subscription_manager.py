@@ -6,8 +6,17 @@ import logging
 import json
 import os
 import base64
+import binascii
+import codecs
+import hashlib
+import re
+import threading
+import time
 import yaml
-from datetime import datetime
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import unquote, parse_qs
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +24,20 @@ logger = logging.getLogger(__name__)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CACHE_DIR = os.path.join(BASE_DIR, 'cache')
 STORAGE_FILE = os.path.join(CACHE_DIR, 'url_storage.json')
+# 预热结果（上游订阅、转换服务响应），所有worker进程共享
+PREWARM_DIR = os.path.join(CACHE_DIR, 'prewarm')
+# 预热结果在多长时间内（秒）可以直接给客户端请求使用
+PREWARM_FRESH_SECONDS = int(os.environ.get('PREWARM_FRESH_SECONDS', '600'))
+# 预热线程之间复用结果的时间（秒）：同一轮预热里多个请求共用同一个上游时只下载一次
+PREWARM_REUSE_SECONDS = 60
+# 上游订阅/转换结果/上传文件的最大字节数（解压后），超过立即中止
+MAX_DOWNLOAD_BYTES = int(os.environ.get('MAX_DOWNLOAD_BYTES', str(20 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# 响应开头是这些内容时不是订阅（机场的登录页、Cloudflare验证页等），不再继续下载
+NON_SUBSCRIPTION_PREFIXES = (b'<!doctype', b'<html', b'<head', b'<body', b'<?xml')
+# 至少收到这么多非空白字节（或下载结束）后才检查内容开头，分块传输时第一块可能只有一个换行
+HEAD_CHECK_BYTES = 64
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
 
 # 确保cache目录存在
 if not os.path.exists(CACHE_DIR):
@@ -22,8 +45,205 @@ if not os.path.exists(CACHE_DIR):
     logger.info(f"创建缓存目录: {CACHE_DIR}")
 
 
+_prewarm_state = threading.local()
+
+
+@contextmanager
+def prewarming():
+    """在当前线程内标记为预热：下载结果写入预热缓存，不读取预热缓存"""
+    _prewarm_state.active = True
+    try:
+        yield
+    finally:
+        _prewarm_state.active = False
+
+
+def is_prewarming():
+    return getattr(_prewarm_state, 'active', False)
+
+
+def pop_try_update_keys():
+    """取出并清空当前线程本次请求触发过自动更新的 (key, ua)"""
+    keys = getattr(_prewarm_state, 'try_update_keys', [])
+    _prewarm_state.try_update_keys = []
+    return keys
+
+
+_request_state = threading.local()
+
+
+def begin_request():
+    """请求开始：本次请求内的存储读取只解析一次url_storage.json"""
+    _request_state.active = True
+    _request_state.storage = None
+    _request_state.loaded_entries = {}
+
+
+def end_request(exc=None):
+    _request_state.active = False
+    _request_state.storage = None
+    _request_state.loaded_entries = {}
+
+
+def _prewarm_path(kind, key):
+    digest = hashlib.sha256(f"{kind}\n{key}".encode('utf-8')).hexdigest()
+    return os.path.join(PREWARM_DIR, f"{kind}_{digest}.json")
+
+
+def get_prewarmed(kind, key):
+    """读取仍然新鲜的预热结果；预热线程只复用同一轮里刚下载的结果，保证拿到的是最新内容"""
+    max_age = PREWARM_REUSE_SECONDS if is_prewarming() else PREWARM_FRESH_SECONDS
+    path = _prewarm_path(kind, key)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - data.get('fetched_at', 0) > max_age:
+        return None
+    logger.info(f"使用预热结果: {kind} {key[:80]}")
+    return data
+
+
+def has_fresh_prewarmed(kind, key):
+    """只看文件修改时间判断是否有新鲜的预热结果，不读取内容（准入判断用）"""
+    try:
+        return time.time() - os.path.getmtime(_prewarm_path(kind, key)) <= PREWARM_FRESH_SECONDS
+    except OSError:
+        return False
+
+
+def store_prewarmed(kind, key, data):
+    """预热线程保存结果（先写临时文件再替换，其他进程不会读到半个文件）"""
+    if not is_prewarming():
+        return
+    path = _prewarm_path(kind, key)
+    data = dict(data, fetched_at=time.time())
+    try:
+        os.makedirs(PREWARM_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.error(f"保存预热结果失败: {e}")
+
+
+class DownloadError(Exception):
+    """下载被中止：超过大小上限或返回的不是订阅内容"""
+
+
+def decode_content(raw, declared_charset=None):
+    """
+    字节解码为文本：UTF-8（去掉BOM） -> 声明的charset -> GBK -> UTF-8替换非法字节
+    不做字符集探测，大文件也只需要解码一两次
+    """
+    if raw.startswith(codecs.BOM_UTF8):
+        raw = raw[len(codecs.BOM_UTF8):]
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    for encoding in (declared_charset, 'gbk'):
+        if not encoding:
+            continue
+        try:
+            return raw.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return raw.decode('utf-8', errors='replace')
+
+
+def declared_charset(content_type):
+    """从Content-Type里取charset，没有声明时返回None"""
+    match = CHARSET_PATTERN.search(content_type or '')
+    return match.group(1) if match else None
+
+
+def check_content_head(head):
+    """检查响应开头，HTML页面、二进制内容直接抛出DownloadError"""
+    if head.startswith(codecs.BOM_UTF8):
+        head = head[len(codecs.BOM_UTF8):]
+    head = head.lstrip()[:1024]
+    if head[:64].lower().startswith(NON_SUBSCRIPTION_PREFIXES):
+        raise DownloadError('返回的是HTML/XML页面，不是订阅内容')
+    if b'\x00' in head:
+        raise DownloadError('返回的是二进制内容，不是订阅内容')
+
+
+def read_limited(stream, max_bytes=MAX_DOWNLOAD_BYTES):
+    """从文件对象读取不超过max_bytes的内容，超过时抛出DownloadError"""
+    raw = stream.read(max_bytes + 1)
+    if len(raw) > max_bytes:
+        raise DownloadError(f'内容超过大小上限 {max_bytes} 字节')
+    return raw
+
+
+def fetch_text(url, headers=None, timeout=30, verify=True):
+    """
+    流式下载并解码为文本，返回 (status_code, response_headers, text)
+    分块读取，Content-Length或实际大小超过MAX_DOWNLOAD_BYTES时中止；
+    200响应开头是HTML/二进制时中止（非200时保留正文作为错误信息）
+    """
+    with requests.get(url, headers=headers, timeout=timeout, verify=verify, stream=True) as response:
+        content_length = response.headers.get('Content-Length', '')
+        if content_length.isdigit() and int(content_length) > MAX_DOWNLOAD_BYTES:
+            raise DownloadError(f'内容大小 {content_length} 字节超过上限 {MAX_DOWNLOAD_BYTES} 字节')
+
+        chunks = []
+        size = 0
+        head = bytearray()
+        head_non_space = 0
+        head_checked = response.status_code != 200
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            if not chunk:
+                continue
+            size += len(chunk)
+            if size > MAX_DOWNLOAD_BYTES:
+                raise DownloadError(f'内容超过大小上限 {MAX_DOWNLOAD_BYTES} 字节')
+            chunks.append(chunk)
+            if not head_checked:
+                head.extend(chunk)
+                head_non_space += len(chunk.translate(None, b' \t\r\n'))
+                if head_non_space >= HEAD_CHECK_BYTES:
+                    check_content_head(bytes(head))
+                    head_checked = True
+        if not head_checked:
+            check_content_head(bytes(head))
+
+        text = decode_content(b''.join(chunks), declared_charset(response.headers.get('Content-Type')))
+        return response.status_code, response.headers, text
+
+
+class ClashYamlLoader(yaml.SafeLoader):
+    """
+    SafeLoader，但 short-id 按原文保留为字符串
+    （否则 0123 会被当成八进制数字、1e10 会被当成浮点数）
+    """
+
+    def construct_mapping(self, node, deep=False):
+        for key_node, value_node in node.value:
+            if (key_node.value == 'short-id' and isinstance(value_node, yaml.ScalarNode)
+                    and value_node.value not in ('', '~', 'null', 'Null', 'NULL')):
+                value_node.tag = 'tag:yaml.org,2002:str'
+        return super().construct_mapping(node, deep)
+
+
+def load_yaml_text(content):
+    """解析订阅/配置YAML文本（short-id保持字符串）"""
+    return yaml.load(content, Loader=ClashYamlLoader)
+
+
 def get_storage():
-    """从JSON文件读取存储数据"""
+    """从JSON文件读取存储数据（请求内复用第一次读取的结果）"""
+    if getattr(_request_state, 'active', False):
+        if _request_state.storage is None:
+            _request_state.storage = _read_storage_file()
+        return _request_state.storage
+    return _read_storage_file()
+
+
+def _read_storage_file():
     try:
         if os.path.exists(STORAGE_FILE):
             with open(STORAGE_FILE, 'r', encoding='utf-8') as f:
@@ -42,9 +262,11 @@ def get_storage_item(key):
 
 
 def set_storage_item(key, value):
-    """保存键值对到JSON文件"""
-    storage = get_storage()
+    """保存键值对到JSON文件（基于文件最新内容修改，同时更新本次请求读到的存储）"""
+    storage = _read_storage_file()
     storage[key] = value
+    if getattr(_request_state, 'storage', None) is not None:
+        _request_state.storage[key] = value
     try:
         with open(STORAGE_FILE, 'w', encoding='utf-8') as f:
             json.dump(storage, f, ensure_ascii=False, indent=2)
@@ -54,6 +276,65 @@ def set_storage_item(key, value):
         raise
 
 
+def has_try_update(urls):
+    """key://来源里是否有开启try_update的key（请求时会下载上游）"""
+    storage = get_storage()
+    for u in urls:
+        if isinstance(u, str) and u.startswith('key://'):
+            cache_data = storage.get(u[6:])
+            if isinstance(cache_data, dict) and cache_data.get('try_update', False):
+                return True
+    return False
+
+
+def served_from_cache(urls, ua):
+    """
+    这些来源是否不需要访问上游：key://没有开启try_update，
+    或http(s)/base64地址在新鲜期内有预热结果
+    """
+    for u in urls:
+        if u.startswith('key://'):
+            if has_try_update([u]):
+                return False
+            continue
+        if u.startswith(('http://', 'https://')):
+            actual_url = u
+        else:
+            try:
+                actual_url = base64.b64decode(u).decode('utf-8')
+            except Exception:
+                return False
+        if not has_fresh_prewarmed('subscription', f"{actual_url}\n{ua}"):
+            return False
+    return True
+
+
+def get_last_modified(urls):
+    """
+    根据key://缓存的cached_time计算Last-Modified
+    只有所有来源都是key://缓存时才返回（取最新的cached_time，UTC，精确到秒），否则返回None
+    cached_time取本次请求download_subscription已经读到（或自动更新后）的条目，不再读取存储；
+    没有下载过的来源返回None
+    """
+    if not urls or not all(isinstance(u, str) and u.startswith('key://') for u in urls):
+        return None
+
+    loaded_entries = getattr(_request_state, 'loaded_entries', None) or {}
+    latest = None
+    for u in urls:
+        cache_data = loaded_entries.get(u[6:])
+        if not isinstance(cache_data, dict) or not cache_data.get('cached_time'):
+            return None
+        try:
+            # cached_time是本地时间的isoformat，没有时区信息
+            cached_time = datetime.fromisoformat(cache_data['cached_time']).astimezone(timezone.utc)
+        except ValueError:
+            return None
+        if latest is None or cached_time > latest:
+            latest = cached_time
+    return latest.replace(microsecond=0)
+
+
 def download_subscription(url, ua='clash-verge/v2.4.3'):
     """
     下载订阅配置
@@ -79,10 +360,16 @@ def download_subscription(url, ua='clash-verge/v2.4.3'):
         if not isinstance(cache_data, dict) or 'yaml_content' not in cache_data:
             logger.error(f"缓存数据格式错误: {key_name}")
             return None, None, 500
+        if getattr(_request_state, 'active', False):
+            # 供get_last_modified使用；自动更新时原地修改，cached_time保持一致
+            _request_state.loaded_entries[key_name] = cache_data
 
         # 检查是否需要尝试更新
         if cache_data.get('try_update', False):
             original_url = cache_data.get('url')
+            if not is_prewarming():
+                # 记录下来，由预热调度器在客户端下次轮询前提前更新
+                _prewarm_state.try_update_keys = getattr(_prewarm_state, 'try_update_keys', []) + [(key_name, ua)]
             if original_url:
                 logger.info(f"触发自动更新: {key_name}")
                 try:
@@ -129,23 +416,35 @@ def download_subscription(url, ua='clash-verge/v2.4.3'):
     headers = {'User-Agent': ua}
     # headers = {'User-Agent': ua,"Accept":"*/*","Accept-Encoding":"gzip, deflate, br","Connection":"keep-alive","Cache-Control":"no-cache"}
 
+    # 预热调度器刚下载过时直接使用
+    prewarm_key = f"{actual_url}\n{ua}"
+    prewarmed = get_prewarmed('subscription', prewarm_key)
+    if prewarmed is not None:
+        return prewarmed['content'], prewarmed['subscription_userinfo'], 200
+
     try:
         logger.info(f"下载订阅: {actual_url}")
-        response = requests.get(actual_url, headers=headers, timeout=30, verify=False)
+        status_code, response_headers, yaml_content = fetch_text(actual_url, headers=headers, timeout=30, verify=False)
         # 打印此次请求的headers，包括请求头和响应头
         logger.info(f"请求头: {headers}")
-        logger.info(f"响应头: {response.headers}")
+        logger.info(f"响应头: {response_headers}")
         
-        if response.status_code != 200:
-            logger.error(f"订阅下载失败，状态码: {response.status_code}")
-            return None, None, response.status_code
+        if status_code != 200:
+            logger.error(f"订阅下载失败，状态码: {status_code}")
+            return None, None, status_code
         
-        yaml_content = response.text
-        subscription_userinfo = response.headers.get('Subscription-Userinfo', '')
+        subscription_userinfo = response_headers.get('Subscription-Userinfo', '')
         
-        logger.info(f"订阅下载成功，大小: {len(yaml_content)} 字节")
+        logger.info(f"订阅下载成功，大小: {len(yaml_content)} 字符")
+        store_prewarmed('subscription', prewarm_key, {
+            'content': yaml_content,
+            'subscription_userinfo': subscription_userinfo,
+        })
         return yaml_content, subscription_userinfo, 200
         
+    except DownloadError as e:
+        logger.error(f"订阅下载中止: {actual_url}: {e}")
+        return None, None, 502
     except requests.exceptions.RequestException as e:
         logger.error(f"下载订阅时出错: {e}")
         return None, None, 500
@@ -153,3 +452,371 @@ def download_subscription(url, ua='clash-verge/v2.4.3'):
         logger.error(f"处理订阅时出错: {e}")
         return None, None, 500
 
+
+# 支持本地解码的分享链接协议（hy2是hysteria2的简写）
+SHARE_LINK_SCHEMES = ('ss', 'vmess', 'vless', 'trojan', 'hysteria2', 'hy2')
+SHARE_LINK_PREFIXES = tuple(f"{scheme}://" for scheme in SHARE_LINK_SCHEMES)
+
+# 通用 userinfo@host:port/?query#name 形式的分享链接
+SHARE_LINK_PATTERN = re.compile(
+    r'^(?P<userinfo>[^@]*)@(?P<host>\[[^\]]+\]|[^:/?#\[\]]+):(?P<port>[0-9,\-]+)/?(?:\?(?P<query>[^#]*))?(?:#(?P<name>.*))?$'
+)
+# 端口跳跃写法：443,20000-30000（只有hysteria2支持）
+PORT_LIST_PATTERN = re.compile(r'^\d+(?:-\d+)?(?:,\d+(?:-\d+)?)*$')
+BASE64_PATTERN = re.compile(r'^[A-Za-z0-9+/=_\-\s]+$')
+
+
+def _b64decode(data):
+    """兼容标准/URL安全、缺少padding的base64解码"""
+    data = data.strip().replace('-', '+').replace('_', '/')
+    data = re.sub(r'\s+', '', data)
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+def _extract_share_links(content):
+    """
+    判断订阅内容是否是分享链接列表（明文或base64编码），是则返回链接列表，否则返回None
+    只看开头做判断，不会对YAML订阅做base64解码
+    """
+    text = content.strip()
+    if not text:
+        return None
+
+    if not text.startswith(SHARE_LINK_PREFIXES):
+        head = text[:256]
+        if ':' in head or not BASE64_PATTERN.match(head):
+            return None
+        try:
+            text = _b64decode(text).decode('utf-8', errors='replace').strip()
+        except (binascii.Error, ValueError):
+            return None
+        if not text.startswith(SHARE_LINK_PREFIXES):
+            return None
+
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def _first(params, key, default=None):
+    values = params.get(key)
+    return values[0] if values else default
+
+
+def _is_true(value):
+    return str(value).lower() in ('1', 'true')
+
+
+def _transport_opts(proxy, network, params):
+    """按分享链接参数设置network及ws/grpc/h2/http传输配置"""
+    network = network or 'tcp'
+    if network in ('tcp', 'none') and _first(params, 'headerType') != 'http':
+        return
+    host = _first(params, 'host')
+    path = _first(params, 'path')
+    if network == 'ws':
+        opts = {'path': path or '/'}
+        if host:
+            opts['headers'] = {'Host': host}
+        proxy['network'] = 'ws'
+        proxy['ws-opts'] = opts
+    elif network == 'grpc':
+        proxy['network'] = 'grpc'
+        proxy['grpc-opts'] = {'grpc-service-name': _first(params, 'serviceName') or path or ''}
+    elif network in ('h2', 'http'):
+        opts = {'path': path or '/'}
+        if host:
+            opts['host'] = host.split(',')
+        proxy['network'] = 'h2'
+        proxy['h2-opts'] = opts
+    elif network == 'tcp':
+        opts = {'path': [path or '/']}
+        if host:
+            opts['headers'] = {'Host': host.split(',')}
+        proxy['network'] = 'http'
+        proxy['http-opts'] = opts
+    else:
+        proxy['network'] = network
+
+
+def _tls_opts(proxy, params, sni_key='servername'):
+    sni = _first(params, 'sni') or _first(params, 'peer')
+    if sni:
+        proxy[sni_key] = sni
+    alpn = _first(params, 'alpn')
+    if alpn:
+        proxy['alpn'] = alpn.split(',')
+    fingerprint = _first(params, 'fp')
+    if fingerprint:
+        proxy['client-fingerprint'] = fingerprint
+    if _is_true(_first(params, 'allowInsecure')) or _is_true(_first(params, 'insecure')):
+        proxy['skip-cert-verify'] = True
+
+
+def _match_links(bodies, allow_port_list=False):
+    """
+    批量匹配 userinfo@host:port?query#name，返回 (匹配对象, query参数, 节点名)，无法匹配的为None
+    allow_port_list=True 时接受 443,20000-30000 形式的端口列表，否则端口必须是单个数字
+    """
+    results = []
+    for match in map(SHARE_LINK_PATTERN.match, bodies):
+        if match is None:
+            results.append(None)
+            continue
+        port = match.group('port')
+        if not (port.isdigit() or (allow_port_list and PORT_LIST_PATTERN.match(port))):
+            results.append(None)
+            continue
+        params = parse_qs(match.group('query') or '', keep_blank_values=False)
+        results.append((match, params, unquote(match.group('name') or '')))
+    return results
+
+
+def _host(match):
+    return match.group('host').strip('[]')
+
+
+def _parse_ss_links(bodies):
+    proxies = []
+    for body in bodies:
+        try:
+            name = ''
+            if '#' in body:
+                body, name = body.split('#', 1)
+                name = unquote(name)
+            if '@' not in body:
+                # 旧格式: ss://base64(method:password@host:port)#name
+                body = _b64decode(body.split('?')[0].rstrip('/')).decode('utf-8')
+            userinfo, _, hostinfo = body.rpartition('@')
+            match = SHARE_LINK_PATTERN.match(f"x@{hostinfo}")
+            if match is None or not match.group('port').isdigit():
+                proxies.append(None)
+                continue
+            userinfo = unquote(userinfo)
+            if ':' not in userinfo:
+                userinfo = _b64decode(userinfo).decode('utf-8')
+            cipher, password = userinfo.split(':', 1)
+            proxy = {
+                'name': name,
+                'type': 'ss',
+                'server': _host(match),
+                'port': int(match.group('port')),
+                'cipher': cipher,
+                'password': password,
+                'udp': True,
+            }
+            plugin = _first(parse_qs(match.group('query') or ''), 'plugin')
+            if plugin:
+                plugin_name, *plugin_args = plugin.split(';')
+                plugin_opts = dict(arg.split('=', 1) if '=' in arg else (arg, True) for arg in plugin_args)
+                if plugin_name in ('obfs-local', 'simple-obfs'):
+                    proxy['plugin'] = 'obfs'
+                    proxy['plugin-opts'] = {'mode': plugin_opts.get('obfs', 'http'), 'host': plugin_opts.get('obfs-host', '')}
+                elif plugin_name == 'v2ray-plugin':
+                    proxy['plugin'] = 'v2ray-plugin'
+                    proxy['plugin-opts'] = {
+                        'mode': plugin_opts.get('mode', 'websocket'),
+                        'host': plugin_opts.get('host', ''),
+                        'path': plugin_opts.get('path', '/'),
+                        'tls': 'tls' in plugin_opts,
+                    }
+                else:
+                    proxy['plugin'] = plugin_name
+                    proxy['plugin-opts'] = plugin_opts
+            proxies.append(proxy)
+        except (ValueError, UnicodeDecodeError, binascii.Error):
+            proxies.append(None)
+    return proxies
+
+
+def _parse_vmess_links(bodies):
+    proxies = []
+    for body in bodies:
+        try:
+            info = json.loads(_b64decode(body.split('#')[0]).decode('utf-8'))
+            if not isinstance(info, dict):
+                proxies.append(None)
+                continue
+            proxy = {
+                'name': str(info.get('ps') or ''),
+                'type': 'vmess',
+                'server': info['add'],
+                'port': int(info['port']),
+                'uuid': info['id'],
+                'alterId': int(info.get('aid') or 0),
+                'cipher': info.get('scy') or 'auto',
+                'udp': True,
+            }
+            if info.get('tls') == 'tls':
+                proxy['tls'] = True
+                if info.get('sni'):
+                    proxy['servername'] = info['sni']
+                if info.get('alpn'):
+                    proxy['alpn'] = str(info['alpn']).split(',')
+                if info.get('fp'):
+                    proxy['client-fingerprint'] = info['fp']
+            params = {k: [str(v)] for k, v in info.items() if k in ('host', 'path') and v}
+            if info.get('type') == 'http':
+                params['headerType'] = ['http']
+            if info.get('net') == 'grpc' and info.get('path'):
+                params['serviceName'] = [str(info['path'])]
+            _transport_opts(proxy, info.get('net'), params)
+            proxies.append(proxy)
+        except (ValueError, KeyError, TypeError, UnicodeDecodeError, binascii.Error):
+            proxies.append(None)
+    return proxies
+
+
+def _parse_vless_links(bodies):
+    proxies = []
+    for item in _match_links(bodies):
+        if item is None:
+            proxies.append(None)
+            continue
+        match, params, name = item
+        proxy = {
+            'name': name,
+            'type': 'vless',
+            'server': _host(match),
+            'port': int(match.group('port')),
+            'uuid': unquote(match.group('userinfo')),
+            'udp': True,
+        }
+        security = _first(params, 'security')
+        if security in ('tls', 'reality'):
+            proxy['tls'] = True
+            _tls_opts(proxy, params)
+        if security == 'reality':
+            # short-id 保持字符串，避免被当成数字
+            proxy['reality-opts'] = {'public-key': _first(params, 'pbk', ''), 'short-id': _first(params, 'sid', '')}
+        flow = _first(params, 'flow')
+        if flow:
+            proxy['flow'] = flow
+        _transport_opts(proxy, _first(params, 'type'), params)
+        proxies.append(proxy)
+    return proxies
+
+
+def _parse_trojan_links(bodies):
+    proxies = []
+    for item in _match_links(bodies):
+        if item is None:
+            proxies.append(None)
+            continue
+        match, params, name = item
+        proxy = {
+            'name': name,
+            'type': 'trojan',
+            'server': _host(match),
+            'port': int(match.group('port')),
+            'password': unquote(match.group('userinfo')),
+            'udp': True,
+        }
+        _tls_opts(proxy, params, sni_key='sni')
+        _transport_opts(proxy, _first(params, 'type'), params)
+        proxies.append(proxy)
+    return proxies
+
+
+def _parse_hysteria2_links(bodies):
+    proxies = []
+    for item in _match_links(bodies, allow_port_list=True):
+        if item is None:
+            proxies.append(None)
+            continue
+        match, params, name = item
+        port = match.group('port')
+        proxy = {
+            'name': name,
+            'type': 'hysteria2',
+            'server': _host(match),
+            # 端口跳跃时port取第一个端口，完整列表放到ports
+            'port': int(re.match(r'\d+', port).group()),
+            'password': unquote(match.group('userinfo')),
+        }
+        if not port.isdigit():
+            proxy['ports'] = port
+        _tls_opts(proxy, params, sni_key='sni')
+        obfs = _first(params, 'obfs')
+        if obfs:
+            proxy['obfs'] = obfs
+            proxy['obfs-password'] = _first(params, 'obfs-password', '')
+        ports = _first(params, 'mport')
+        if ports:
+            proxy['ports'] = ports
+        proxies.append(proxy)
+    return proxies
+
+
+SHARE_LINK_PARSERS = {
+    'ss': _parse_ss_links,
+    'vmess': _parse_vmess_links,
+    'vless': _parse_vless_links,
+    'trojan': _parse_trojan_links,
+    'hysteria2': _parse_hysteria2_links,
+    'hy2': _parse_hysteria2_links,
+}
+
+
+def _run_share_link_parser(scheme, bodies):
+    """批量解析一种协议；批量解析出错时逐条重试，单条坏链接不影响其他链接"""
+    parser = SHARE_LINK_PARSERS[scheme]
+    try:
+        return parser(bodies)
+    except Exception as e:
+        logger.warning(f"{scheme} 分享链接批量解析出错，逐条重试: {e}")
+    results = []
+    for body in bodies:
+        try:
+            results.append(parser([body])[0])
+        except Exception:
+            results.append(None)
+    return results
+
+
+def parse_share_links(links):
+    """
+    把分享链接列表解析为Clash proxies
+    按协议分组后每组批量解析，结果按原顺序输出；无法解析的链接跳过，重名节点加序号
+    """
+    buckets = defaultdict(list)
+    for idx, link in enumerate(links):
+        scheme, sep, body = link.partition('://')
+        if sep and scheme.lower() in SHARE_LINK_PARSERS:
+            buckets[scheme.lower()].append((idx, body))
+
+    parsed = [None] * len(links)
+    for scheme, items in buckets.items():
+        results = _run_share_link_parser(scheme, [body for _, body in items])
+        for (idx, _), proxy in zip(items, results):
+            parsed[idx] = proxy
+
+    proxies = []
+    seen_names = set()
+    for proxy in parsed:
+        if proxy is None:
+            continue
+        base_name = proxy['name'] or f"{proxy['type']}-{proxy['server']}:{proxy['port']}"
+        name = base_name
+        seq = 2
+        while name in seen_names:
+            name = f"{base_name} {seq}"
+            seq += 1
+        seen_names.add(name)
+        proxy['name'] = name
+        proxies.append(proxy)
+
+    skipped = len(links) - len(proxies)
+    if skipped:
+        logger.warning(f"分享链接解析: 跳过 {skipped} 条无法识别的链接")
+    return proxies
+
+
+def parse_subscription(content):
+    """
+    解析订阅内容：base64/明文分享链接列表解析为 {'proxies': [...]}，其余按YAML解析
+    """
+    links = _extract_share_links(content)
+    if links is not None:
+        proxies = parse_share_links(links)
+        logger.info(f"分享链接订阅解析完成: {len(proxies)} 个代理")
+        return {'proxies': proxies}
+    return load_yaml_text(content)